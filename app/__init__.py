@@ -1,5 +1,6 @@
 from __future__ import annotations as _annotations
 
+import importlib
 import sys
 import logging
 from contextlib import asynccontextmanager
@@ -8,38 +9,40 @@ from fastapi import FastAPI
 from fastapi.responses import HTMLResponse, PlainTextResponse
 from fastui import prebuilt_html
 from fastui.dev import dev_fastapi_app
-from httpx import AsyncClient
 from fastapi.staticfiles import StaticFiles
 
 #from .components_list import router as components_router
+from .cities import country_index
+from .dao import ensure_indexes
+from .log import init_logger
+from .metrics import MetricsMiddleware, router as metrics_router
+from .plotting import charting
+from .env import ENV
 from .forms import router as forms_router
 from .main import router as main_router
 from .tables import router as table_router
 from .gilts import router as gilts_router
+from .gilt_import import router as gilt_import_router
 from .charts import router as charts_router
+from .sensitivity import router as sensitivity_router
+from .solver import router as solver_router
+from .portfolio import router as portfolio_router
+from .simulations import router as simulations_router
+from .jobs import router as jobs_router
+from .scenarios import router as scenarios_router
 
 
 @asynccontextmanager
 async def lifespan(app_: FastAPI):
-    async with AsyncClient() as client:
-        app_.state.httpx_client = client
-        yield
-
-def init_logger():
-    logger = logging.getLogger('cashflow')
-    #Set the threshold logging level of the logger to INFO
-    logger.setLevel(logging.INFO)
-    #Create a stream-based handler that writes the log entries    #into the standard output stream
-    handler = logging.StreamHandler(sys.stdout)
-    #Create a formatter for the logs
-
-    time_format = "%Y-%m-%d %H:%M:%S"
-    formatter = logging.Formatter(fmt='%(levelname)s:%(asctime)s.%(msecs)03d::%(name)s:%(module)s:%(funcName)s:%(message)s', datefmt=time_format)
-
-    handler.setFormatter(formatter)
-        #Set the created formatter as the formatter of the handler    handler.setFormatter(formatter)
-    #Add the created handler to this logger
-    logger.addHandler(handler)
+    # build the country search index before the first keystroke needs it
+    country_index()
+    ensure_indexes()
+    if ENV().preload:
+        # pay for matplotlib and pandas before the first chart request rather than during it
+        charting()
+        for module in ('pandas', 'yfinance'):
+            importlib.import_module(module)
+    yield
 
 init_logger()
 logger = logging.getLogger('cashflow')
@@ -54,14 +57,23 @@ else:
     app = FastAPI(lifespan=lifespan)
 
 
+app.add_middleware(MetricsMiddleware)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # app.include_router(components_router, prefix='/api/components')
 app.include_router(table_router, prefix='/api/table')
 app.include_router(forms_router, prefix='/api/forms')
 app.include_router(gilts_router, prefix='/api/gilts')
+app.include_router(gilt_import_router, prefix='/api/gilts')
 app.include_router(charts_router, prefix='/charts')
+app.include_router(sensitivity_router, prefix='/charts')
+app.include_router(solver_router, prefix='/api/solver')
+app.include_router(portfolio_router, prefix='/api/portfolio')
+app.include_router(simulations_router, prefix='/api/simulations')
+app.include_router(jobs_router, prefix='/api/jobs')
+app.include_router(scenarios_router, prefix='/api/scenarios')
 app.include_router(main_router, prefix='/api')
+app.include_router(metrics_router)
 
 
 @app.get('/robots.txt', response_class=PlainTextResponse)
@@ -1,49 +1,120 @@
 from __future__ import annotations as _annotations
 
 
-from fastapi.responses import HTMLResponse
-from fastapi import APIRouter
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, Response
+from fastapi import APIRouter, HTTPException, Request
+from functools import lru_cache
+from pydantic import TypeAdapter
 
-from .gilts import create_image
+from .gilts import gilts_chart, gilts_chart_image
 from .cashflow import cashflow_plot
+from .closes import UnknownTicker
+from .metrics import track_cache
+from .plotting import ImageFormat, MEDIA_TYPES
+from .portfolio import market_version
+from .shared import not_modified, validators
+from .singleflight import SingleFlight
 from .forms import PotModel, PotEnum, IncomeModel, ParametersModel
-from .dao import read_pot, read_income, read_parameters
+from .dao import read_pots, read_incomes, read_parameters
+import hashlib
 import logging
 
 logger = logging.getLogger('cashflow')
 router = APIRouter()
 
-@router.get('/cashflow')
-async def charts_cashflow_landing() -> HTMLResponse:
+
+def read_scenario(cashflow_id: int) -> tuple[list[PotModel], list[IncomeModel], ParametersModel]:
+    pm = read_parameters(cashflow_id)
+    if pm is None:
+        raise HTTPException(status_code=404, detail=f"Cashflow {cashflow_id} not found")
 
     pots = []
-    for i in range(1,5):
-        db = read_pot(i)
-        p = PotModel(pot_id=db.pot_id,name=db.name, type=db.type, amount=db.amount, select_single = PotEnum('isa'))
+    for db in read_pots(cashflow_id):
+        p = PotModel(pot_id=db.pot_id, cashflow_id=db.cashflow_id, name=db.name, type=db.type, amount=db.amount,
+                     select_single = PotEnum('isa'))
         pots.append(p)
 
     incomes = []
-    for i in range(1,5):
-        dbi = read_income(i)
-        income = IncomeModel(income_id=dbi.income_id,name=dbi.name, type=dbi.type, amount=dbi.amount,
-                    inflation_yearly=True, repeating_yearly=True, start_date = dbi.start_date)
+    for dbi in read_incomes(cashflow_id):
+        income = IncomeModel(income_id=dbi.income_id, cashflow_id=dbi.cashflow_id, name=dbi.name, type=dbi.type,
+                    amount=dbi.amount, inflation_yearly=True, repeating_yearly=True, start_date = dbi.start_date)
         incomes.append(income)
 
+    params = ParametersModel(cashflow_id=pm.cashflow_id, target_income=pm.target_income, inflation=pm.inflation,
+                             growth=pm.growth, age=pm.age, retirement_age=pm.retirement_age,
+                             charges=pm.charges,historical_start_year=pm.historical_start_year,years=pm.years,ticker=pm.ticker)
 
-    cashflow_id = 1
-    pm = read_parameters(cashflow_id)
+    return pots, incomes, params
 
-    params = ParametersModel(target_income=pm.target_income, inflation=pm.inflation,growth=pm.growth,
-                             age=pm.age, retirement_age=pm.retirement_age,
-                             charges=pm.charges,historical_start_year=pm.historical_start_year,years=pm.years,ticker=pm.ticker)
 
+@router.get('/cashflow')
+async def charts_cashflow_landing() -> HTMLResponse:
+    return await charts_cashflow(1)
+
+cashflow_flight = SingleFlight('charts_cashflow')
+
+
+def cashflow_html(cashflow_id: int) -> str:
+    pots, incomes, params = read_scenario(cashflow_id)
+
+    try:
+        return cashflow_plot(pots, incomes,params)
+    except UnknownTicker as e:
+        raise HTTPException(status_code=422, detail=str(e))
 
-    html = cashflow_plot(pots, incomes,params)
+
+@router.get('/cashflow/{cashflow_id:int}')
+async def charts_cashflow(cashflow_id: int) -> HTMLResponse:
+    # tabs opened together share one read and render
+    html = await cashflow_flight.do(cashflow_id, cashflow_html, cashflow_id)
 
     return HTMLResponse(html)
 
+# a scenario as the JSON the images are cached by
+Scenario = TypeAdapter(tuple[list[PotModel], list[IncomeModel], ParametersModel])
+
+image_flight = SingleFlight('charts_image')
+
+
+def image_key(cashflow_id: int) -> tuple[str, str]:
+    """The scenario as JSON, and the version of the market data its returns come from."""
+    pots, incomes, params = read_scenario(cashflow_id)
+    try:
+        # a market refresh or gilt import redraws a chart that uses them
+        market = market_version(params.ticker) if params.growth <= 0 else ''
+    except UnknownTicker as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return Scenario.dump_json((pots, incomes, params)).decode(), market
+
+
+@track_cache
+@lru_cache(maxsize=64)
+def cashflow_image(scenario: str, market: str, fmt: ImageFormat) -> bytes:
+    """The cash flow and spend charts as a static image, once per distinct scenario, market data and format."""
+    try:
+        return cashflow_plot(*Scenario.validate_json(scenario), fmt=fmt)
+    except UnknownTicker as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@router.get('/cashflow/{cashflow_id:int}.{fmt}')
+async def charts_cashflow_image(cashflow_id: int, fmt: ImageFormat, request: Request) -> Response:
+    scenario, market = await run_in_threadpool(image_key, cashflow_id)
+    digest = hashlib.blake2b(f'{scenario}\n{market}'.encode(), digest_size=16).hexdigest()
+    headers = validators(f'{digest}-{fmt}')
+    if not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+
+    image = await image_flight.do((digest, fmt), cashflow_image, scenario, market, fmt)
+    return Response(image, media_type=MEDIA_TYPES[fmt], headers=headers)
+
+
 @router.get('/gilts')
-async def charts_gilts_landing() -> HTMLResponse:
-    html=create_image()
-    return HTMLResponse(html)
+async def charts_gilts_landing(request: Request) -> Response:
+    return await gilts_chart(request)
+
 
+@router.get('/gilts.{fmt}')
+async def charts_gilts_image(fmt: ImageFormat, request: Request) -> Response:
+    return await gilts_chart_image(request, fmt)
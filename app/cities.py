@@ -0,0 +1,232 @@
+from __future__ import annotations as _annotations
+
+import hashlib
+import json
+import logging
+import pickle
+import unicodedata
+from array import array
+from collections import defaultdict
+from functools import cache
+from pathlib import Path
+
+CITIES_JSON = Path(__file__).parent / 'cities.json'
+CITIES_SNAPSHOT = Path(__file__).parent / 'cities.snapshot'
+SNAPSHOT_VERSION = 1
+
+NUMERIC_COLUMNS = {'id': 'q', 'lat': 'd', 'lng': 'd', 'population': 'd'}
+STRING_COLUMNS = ('city', 'city_ascii', 'country', 'iso2', 'iso3', 'admin_name', 'capital')
+
+# restcountries.com regions for every iso3 in cities.json
+REGIONS = {
+    'Africa': ('AGO', 'BDI', 'BEN', 'BFA', 'CAF', 'CIV', 'CMR', 'COD', 'COG', 'DJI', 'DZA', 'EGY',
+               'ERI', 'ETH', 'GAB', 'GHA', 'GIN', 'GMB', 'GNB', 'KEN', 'LBR', 'LBY', 'LSO', 'MAR',
+               'MDG', 'MLI', 'MOZ', 'MRT', 'MWI', 'NER', 'NGA', 'RWA', 'SDN', 'SEN', 'SLE', 'SOM',
+               'SSD', 'TCD', 'TGO', 'TUN', 'TZA', 'UGA', 'ZAF', 'ZMB', 'ZWE'),
+    'Americas': ('ARG', 'BOL', 'BRA', 'CAN', 'CHL', 'COL', 'CRI', 'CUB', 'DOM', 'ECU', 'GTM', 'HND',
+                 'HTI', 'JAM', 'MEX', 'NIC', 'PAN', 'PER', 'PRI', 'PRY', 'SLV', 'URY', 'USA', 'VEN'),
+    'Asia': ('AFG', 'ARE', 'ARM', 'AZE', 'BGD', 'BHR', 'CHN', 'GEO', 'HKG', 'IDN', 'IND', 'IRN',
+             'IRQ', 'ISR', 'JOR', 'JPN', 'KAZ', 'KGZ', 'KHM', 'KOR', 'KWT', 'LAO', 'LBN', 'LKA',
+             'MAC', 'MMR', 'MNG', 'MYS', 'NPL', 'OMN', 'PAK', 'PHL', 'PRK', 'QAT', 'SAU', 'SGP',
+             'SYR', 'THA', 'TJK', 'TKM', 'TUR', 'TWN', 'UZB', 'VNM', 'XGZ', 'YEM'),
+    'Europe': ('ALB', 'AUT', 'BEL', 'BGR', 'BIH', 'BLR', 'CHE', 'CZE', 'DEU', 'DNK', 'ESP', 'EST',
+               'FIN', 'FRA', 'GBR', 'GRC', 'HRV', 'HUN', 'IRL', 'ITA', 'LTU', 'LVA', 'MDA', 'MKD',
+               'MLT', 'NLD', 'NOR', 'POL', 'PRT', 'ROU', 'RUS', 'SRB', 'SVK', 'SWE', 'UKR'),
+    'Oceania': ('AUS', 'NZL', 'PNG'),
+}
+REGION_BY_ISO3 = {iso3: region for region, codes in REGIONS.items() for iso3 in codes}
+
+logger = logging.getLogger('cashflow')
+
+
+class CitiesStore:
+    """
+    Cities held column by column rather than as a list of models.
+
+    Rows are ordered by (iso3, population desc) so every country is one
+    contiguous range, `by_population` keeps the global population order for
+    the unfiltered table and `index` maps a city id to its row.
+    """
+
+    def __init__(self, numeric: dict[str, array], strings: dict[str, tuple[tuple, array]],
+                 countries: dict[str, tuple[int, int]], by_population: array):
+        self.numeric = numeric
+        self.strings = strings
+        self.countries = countries
+        self.by_population = by_population
+        self.index = {city_id: row for row, city_id in enumerate(numeric['id'])}
+
+    def __len__(self) -> int:
+        return len(self.by_population)
+
+    def __str__(self) -> str:
+        return f"{len(self)} cities in {len(self.countries)} countries"
+
+    def row(self, row: int) -> dict:
+        values = {name: column[row] for name, column in self.numeric.items()}
+        for name, (lookup, codes) in self.strings.items():
+            values[name] = lookup[codes[row]]
+        return values
+
+    def rows(self, rows) -> list[dict]:
+        return [self.row(r) for r in rows]
+
+    def country_rows(self, iso3: str) -> range:
+        start, stop = self.countries.get(iso3, (0, 0))
+        return range(start, stop)
+
+    def country_name(self, iso3: str) -> str | None:
+        rows = self.country_rows(iso3)
+        if not rows:
+            return None
+        lookup, codes = self.strings['country']
+        return lookup[codes[rows.start]]
+
+    def lookup(self, city_id: int) -> dict:
+        return self.row(self.index[city_id])
+
+
+def source_digest(source: bytes) -> str:
+    return hashlib.blake2b(source, digest_size=16).hexdigest()
+
+
+def build_store(records: list[dict]) -> CitiesStore:
+    # global order matches the old cities_list(): population desc, ties in file order
+    by_population_order = sorted(range(len(records)), key=lambda i: -records[i]['population'])
+    rank = {i: n for n, i in enumerate(by_population_order)}
+    order = sorted(range(len(records)), key=lambda i: (records[i]['iso3'], rank[i]))
+    position = {i: row for row, i in enumerate(order)}
+
+    numeric = {name: array(typecode, (records[i][name] for i in order))
+               for name, typecode in NUMERIC_COLUMNS.items()}
+
+    strings = {}
+    for name in STRING_COLUMNS:
+        lookup = {}
+        codes = array('I', (lookup.setdefault(records[i][name], len(lookup)) for i in order))
+        strings[name] = (tuple(lookup), codes)
+
+    countries = {}
+    iso3_lookup, iso3_codes = strings['iso3']
+    for row, code in enumerate(iso3_codes):
+        start, _ = countries.get(iso3_lookup[code], (row, row))
+        countries[iso3_lookup[code]] = (start, row + 1)
+
+    by_population = array('I', (position[i] for i in by_population_order))
+
+    return CitiesStore(numeric, strings, countries, by_population)
+
+
+def write_snapshot(store: CitiesStore, digest: str, path: Path = CITIES_SNAPSHOT):
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'source_digest': digest,
+        'numeric': store.numeric,
+        'strings': store.strings,
+        'countries': store.countries,
+        'by_population': store.by_population,
+    }
+    tmp = path.with_suffix('.tmp')
+    tmp.write_bytes(pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL))
+    tmp.replace(path)
+
+
+def read_snapshot(digest: str, path: Path = CITIES_SNAPSHOT) -> CitiesStore | None:
+    try:
+        snapshot = pickle.loads(path.read_bytes())
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+
+    if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('source_digest') != digest:
+        return None
+
+    return CitiesStore(snapshot['numeric'], snapshot['strings'],
+                       snapshot['countries'], snapshot['by_population'])
+
+
+def load_cities() -> CitiesStore:
+    source = CITIES_JSON.read_bytes()
+    digest = source_digest(source)
+
+    store = read_snapshot(digest)
+    if store is not None:
+        return store
+
+    logger.info(f"Cities snapshot missing or stale, rebuilding from {CITIES_JSON.name}")
+    store = build_store(json.loads(source))
+    try:
+        write_snapshot(store, digest)
+    except OSError as e:
+        logger.warning(f"Could not write cities snapshot: {e}")
+
+    return store
+
+
+@cache
+def cities_store() -> CitiesStore:
+    return load_cities()
+
+
+def fold(text: str) -> str:
+    # "Côte d'Ivoire" should match "cote"
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold()
+
+
+class CountryIndex:
+    """
+    Substring index over country names, iso3 codes and regions.
+
+    Every substring of every folded country name is a key, so a query is a
+    single dict lookup. Matches are ranked name-prefix first, then anywhere in
+    the name, then iso3 code or region.
+    """
+
+    def __init__(self, countries: list[tuple[str, str, str, float]], top: int = 20):
+        # countries are (iso3, name, region, population)
+        self.countries = sorted(countries, key=lambda co: co[1])
+        ranked = defaultdict(dict)
+        for n, (iso3, name, region, _) in enumerate(self.countries):
+            folded = fold(name)
+            for start in range(len(folded)):
+                rank = 0 if start == 0 else 1
+                for stop in range(start + 1, len(folded) + 1):
+                    key = folded[start:stop]
+                    ranked[key][n] = min(rank, ranked[key].get(n, rank))
+            for other in (fold(iso3), fold(region)):
+                ranked[other].setdefault(n, 2)
+
+        self.index = {key: tuple(sorted(matches, key=lambda n: (matches[n], n)))
+                      for key, matches in ranked.items()}
+
+        by_population = sorted(range(len(self.countries)), key=lambda n: -self.countries[n][3])
+        self.default = tuple(sorted(by_population[:top]))
+
+    def search(self, q: str) -> list[dict]:
+        q = fold(q.strip())
+        matches = self.index.get(q, ()) if q else self.default
+
+        regions = defaultdict(list)
+        for n in matches:
+            iso3, name, region, _ = self.countries[n]
+            regions[region].append({'value': iso3, 'label': name})
+        return [{'label': k, 'options': v} for k, v in regions.items()]
+
+
+@cache
+def country_index() -> CountryIndex:
+    store = cities_store()
+    populations = store.numeric['population']
+    countries = []
+    for iso3, (start, stop) in store.countries.items():
+        population = sum(populations[start:stop])
+        countries.append((iso3, store.country_name(iso3), REGION_BY_ISO3.get(iso3, 'Other'), population))
+    return CountryIndex(countries)
+
+
+if __name__ == '__main__':
+    # python -m app.cities  -- rebuild the snapshot after editing cities.json
+    source = CITIES_JSON.read_bytes()
+    cities = build_store(json.loads(source))
+    write_snapshot(cities, source_digest(source))
+    print(f"Wrote {CITIES_SNAPSHOT.name}: {cities}")
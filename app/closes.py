@@ -0,0 +1,288 @@
+from __future__ import annotations as _annotations
+
+import fcntl
+import logging
+import mmap
+import os
+import re
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import quote, unquote
+
+import numpy as np
+
+from .metrics import span
+
+logger = logging.getLogger('cashflow')
+
+'''
+# Closes file
+======================================================================
+Daily closes in fixed-layout binary files, one per ticker under
+MARKET_DATA, written once and memory-mapped read-only by each worker, so N
+uvicorn workers share one copy through the page cache instead of holding
+N DataFrames.
+
+    header   magic, days, tickers, name width       (32 bytes)
+    names    tickers x name width, NUL padded ASCII
+    dates    days x int64, days since 1970-01-01
+    closes   tickers x days x float64, one column per ticker, NaN where
+             the ticker didn't trade
+
+Everything after the header is 8-byte aligned so the columns map straight
+into numpy arrays. A refresh writes a new file beside the old one and
+renames it over the top; workers notice the new inode on their next read
+and remap, while anything still holding the old mapping keeps a valid view
+of the old file until it lets go.
+
+A ticker is fetched the first time something asks for it, several at once
+when more than one is missing, under a per-ticker lock so only one worker
+downloads it. A symbol Yahoo says doesn't exist, or has no closes for, is
+marked unknown for MARKET_UNKNOWN_TTL seconds rather than being looked up
+on every request; a download that fails is tried again on the next one.
+Tickers come from users, so anything that isn't shaped like a symbol is
+unknown without touching the disk, lock files go once the fetch is done,
+and at most MARKET_MAX_UNKNOWN symbols are marked unknown at a time.
+
+    python -m app.closes [TICKER ...]    # download and swap in fresh closes
+'''
+
+MARKET_DATA = Path(os.getenv('MARKET_DATA', Path(__file__).parent / 'market-data'))
+MAGIC = b'CFCLOSE1'
+HEADER = struct.Struct('<8sQQQ')
+NAME_WIDTH = 16
+# how long a symbol that returned nothing is left alone before asking again
+UNKNOWN_TTL = float(os.getenv('MARKET_UNKNOWN_TTL', '86400'))
+FETCH_WORKERS = 4
+# tickers each worker keeps mapped
+MAX_TICKERS = int(os.getenv('MARKET_MAX_TICKERS', '16'))
+# .unknown markers kept in MARKET_DATA; past this, new unknown symbols aren't remembered
+MAX_UNKNOWN = int(os.getenv('MARKET_MAX_UNKNOWN', '1000'))
+# ^GSPC, BRK-B, VWRL.L, GBPUSD=X
+SYMBOL = re.compile(r'[A-Za-z0-9^.=-]+')
+
+
+class UnknownTicker(ValueError):
+    pass
+
+
+class Closes:
+    """Read-only view of a closes file."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.identity = file_identity(os.fstat(f.fileno()))
+            # the mapping outlives the file descriptor, and the old inode if the file is swapped
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, days, tickers, width = HEADER.unpack_from(self.buffer)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a closes file")
+        offset = HEADER.size
+        names = np.frombuffer(self.buffer, dtype=f'S{width}', count=tickers, offset=offset)
+        offset += align(tickers * width)
+        self.dates = np.frombuffer(self.buffer, dtype='<i8', count=days, offset=offset).view('datetime64[D]')
+        offset += days * 8
+        columns = np.frombuffer(self.buffer, dtype='<f8', count=tickers * days, offset=offset)
+        self.columns = {name.decode(): columns[n * days:(n + 1) * days] for n, name in enumerate(names)}
+
+    @property
+    def tickers(self) -> tuple[str, ...]:
+        return tuple(self.columns)
+
+    def column(self, ticker: str) -> np.ndarray:
+        return self.columns[ticker]
+
+    def stale(self) -> bool:
+        # a refresh renames a new file over the path
+        try:
+            return file_identity(os.stat(self.path)) != self.identity
+        except FileNotFoundError:
+            return False
+
+    def __repr__(self) -> str:
+        dates = f"{self.dates[0]}..{self.dates[-1]}" if len(self.dates) else "empty"
+        return f"Closes({self.path}, {', '.join(self.tickers)}, {dates})"
+
+
+def align(size: int) -> int:
+    return -(-size // 8) * 8
+
+
+def file_identity(stat: os.stat_result) -> tuple[int, int, int]:
+    return stat.st_dev, stat.st_ino, stat.st_mtime_ns
+
+
+def write_closes(path: Path, dates: np.ndarray, columns: dict[str, np.ndarray]):
+    """Write dates and one close column per ticker to path, replacing any existing file atomically."""
+    days = np.asarray(dates, dtype='datetime64[D]').astype('<i8')
+    names = np.array([ticker.encode('ascii') for ticker in columns], dtype=f'S{NAME_WIDTH}')
+    if any(len(ticker) > NAME_WIDTH for ticker in columns):
+        raise ValueError(f"Ticker names are limited to {NAME_WIDTH} characters")
+
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(days), len(columns), NAME_WIDTH))
+        f.write(names.tobytes().ljust(align(names.nbytes), b'\0'))
+        f.write(days.tobytes())
+        for column in columns.values():
+            column = np.asarray(column, dtype='<f8')
+            if len(column) != len(days):
+                raise ValueError(f"Expected {len(days)} closes, got {len(column)}")
+            f.write(column.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    tmp.replace(path)
+
+
+def frame_closes(frame) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """Dates and close columns from a yf.download(group_by='ticker') frame."""
+    dates = frame.index.values.astype('datetime64[D]')
+    tickers = dict.fromkeys(frame.columns.get_level_values(0))
+    return dates, {ticker: frame[ticker]['Close'].to_numpy(dtype=float) for ticker in tickers}
+
+
+def checked(ticker: str) -> str:
+    if len(ticker) > NAME_WIDTH or not SYMBOL.fullmatch(ticker):
+        raise UnknownTicker(f"{ticker[:NAME_WIDTH * 2]!r} isn't a ticker symbol")
+    return ticker
+
+
+def ticker_path(ticker: str, directory: Path = MARKET_DATA) -> Path:
+    # ^GSPC -> %5EGSPC.closes
+    return directory / f"{quote(checked(ticker), safe='')}.closes"
+
+
+def unknown_path(ticker: str, directory: Path = MARKET_DATA) -> Path:
+    return directory / f"{quote(checked(ticker), safe='')}.unknown"
+
+
+def mark_unknown(ticker: str, directory: Path = MARKET_DATA):
+    """Remember that ticker returned nothing, unless too many others already are."""
+    markers = list(directory.glob('*.unknown'))
+    if len(markers) >= MAX_UNKNOWN:
+        now = time.time()
+        for marker in markers:
+            try:
+                if now - marker.stat().st_mtime >= UNKNOWN_TTL:
+                    marker.unlink()
+            except FileNotFoundError:
+                pass
+        if len(list(directory.glob('*.unknown'))) >= MAX_UNKNOWN:
+            logger.warning(f"{MAX_UNKNOWN} unknown tickers already marked, not marking {ticker}")
+            return
+    unknown_path(ticker, directory).touch()
+
+
+def known_unknown(ticker: str, directory: Path = MARKET_DATA) -> bool:
+    """Whether a recent fetch (by any worker) found nothing for ticker."""
+    try:
+        return time.time() - unknown_path(ticker, directory).stat().st_mtime < UNKNOWN_TTL
+    except FileNotFoundError:
+        return False
+
+
+def download_ticker(ticker: str, start: str, end: str) -> tuple[np.ndarray, np.ndarray]:
+    import yfinance as yf
+    from yfinance.exceptions import YFTickerMissingError
+
+    # a Ticker per call, yf.download() keeps its results in module globals; raise_errors, as otherwise
+    # a network error comes back as the same empty frame as a symbol that doesn't exist
+    with span('market_download'):
+        try:
+            frame = yf.Ticker(ticker).history(start=f'{start}-01-01', end=f'{end}-01-01', auto_adjust=False,
+                                              raise_errors=True)
+        except YFTickerMissingError:
+            # no such symbol, or no prices for it in these years
+            frame = None
+    logger.debug("Downloaded %s returns data\n%s", ticker, frame)
+    if frame is None or frame.empty or 'Close' not in frame:
+        return np.empty(0, dtype='datetime64[D]'), np.empty(0)
+
+    closes = frame['Close'].to_numpy(dtype=float)
+    dates = frame.index.tz_localize(None).values.astype('datetime64[D]')
+    traded = ~np.isnan(closes)
+    return dates[traded], closes[traded]
+
+
+def fetch_ticker(ticker: str, start: str, end: str, directory: Path = MARKET_DATA, refresh: bool = False) -> bool:
+    """
+    Download ticker into its closes file, unless another worker already has.
+    False if it is unknown or the download failed.
+    """
+    path = ticker_path(ticker, directory)
+    with locked(path):
+        # another worker may have fetched it while this one waited for the lock
+        if path.exists() and not refresh:
+            return True
+        if known_unknown(ticker, directory) and not refresh:
+            return False
+
+        try:
+            dates, closes = download_ticker(ticker, start, end)
+        except Exception as e:
+            # says nothing about the symbol, so it isn't marked and the next request tries again
+            logger.warning(f"Couldn't download {ticker} returns data: {e!r}")
+            return False
+        if not len(closes):
+            logger.warning(f"No returns data for {ticker}, not trying again for {UNKNOWN_TTL:.0f}s")
+            mark_unknown(ticker, directory)
+            return False
+
+        write_closes(path, dates, {ticker: closes})
+        unknown_path(ticker, directory).unlink(missing_ok=True)
+        logger.info(f"Fetched {len(closes)} {ticker} closes into {path}")
+        return True
+
+
+def fetch_tickers(tickers, start: str, end: str, directory: Path = MARKET_DATA,
+                  refresh: bool = False) -> dict[str, bool]:
+    """Fetch every ticker without a closes file, several at once."""
+    directory.mkdir(parents=True, exist_ok=True)
+    missing = [t for t in dict.fromkeys(map(checked, tickers)) if refresh or not ticker_path(t, directory).exists()]
+    if not missing:
+        return {}
+    logger.info(f"Looking up returns data for {missing}")
+    if len(missing) == 1:
+        return {missing[0]: fetch_ticker(missing[0], start, end, directory, refresh)}
+    with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(missing))) as pool:
+        found = pool.map(lambda t: fetch_ticker(t, start, end, directory, refresh), missing)
+        return dict(zip(missing, found))
+
+
+@contextmanager
+def locked(path: Path):
+    # exclusive lock on a file beside path, so only one worker downloads it at a time
+    lock_path = path.with_name(f'{path.name}.lock')
+    while True:
+        lock = open(lock_path, 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # the worker that held it before may have removed the file, then lock the one now there
+        try:
+            if file_identity(os.fstat(lock.fileno()))[:2] == file_identity(os.stat(lock_path))[:2]:
+                break
+        except FileNotFoundError:
+            pass
+        lock.close()
+    try:
+        yield
+    finally:
+        # removed while still held, so nobody can lock it after this
+        lock_path.unlink(missing_ok=True)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+
+if __name__ == '__main__':
+    import sys
+
+    from .market import stock_returns
+
+    # refresh every ticker already on disk, or the ones named
+    stock = stock_returns()
+    tickers = sys.argv[1:] or [unquote(p.stem) for p in MARKET_DATA.glob('*.closes')]
+    fetch_tickers(tickers, stock.start, stock.end, refresh=True)
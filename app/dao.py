@@ -1,8 +1,28 @@
-from app.env import DB
-from sqlalchemy import Boolean, create_engine, Column, Integer, String, Date, Float
-from sqlalchemy import update
+from app.env import ENV, database
+from app.metrics import track_cache
+from collections import OrderedDict, namedtuple
+from dataclasses import dataclass
+from sqlalchemy import Boolean, Column, Integer, String, Date, Float
+from sqlalchemy import select, update
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import DeclarativeBase, sessionmaker
 import logging
+import threading
+import time
+
+'''
+# Scenario rows
+======================================================================
+A cashflow's pots, incomes and parameters are read together, once, and
+kept in memory (ScenarioCache) until one of the writes below changes them
+or SCENARIO_CACHE_TTL seconds pass; at most SCENARIO_CACHE_SIZE cashflows
+are kept, least recently used first out. Tab switches and chart renders
+then read the same rows without going to the database.
+
+Writes invalidate only this worker's copy; other workers see them once
+their copy's TTL runs out. The rows handed out are shared and detached
+from any session, so treat them as read-only.
+'''
 
 class Base(DeclarativeBase):
     pass
@@ -10,7 +30,7 @@ class Base(DeclarativeBase):
 class Pot(Base):
     __tablename__ = "pots"
     pot_id = Column(Integer, primary_key=True)
-    cashflow_id = Column(Integer)
+    cashflow_id = Column(Integer, index=True)
     name = Column(String)
     type = Column(String)
     amount = Column(Float)
@@ -24,7 +44,7 @@ class Pot(Base):
 class Income(Base):
     __tablename__ = "incomes"
     income_id = Column(Integer, primary_key=True)
-    cashflow_id = Column(Integer)
+    cashflow_id = Column(Integer, index=True)
     name = Column(String)
     type = Column(String)
     amount = Column(Float)
@@ -73,51 +93,134 @@ class Parameters(Base):
                 {self.growth} {self.age} {self.retirement_age} {self.years} {self.ticker} \
                 {self.historical_start_year} {self.charges}"
 
-def read_pot(pot_id) -> Pot:
-    engine = create_engine(db.get_connection_string())
-    Session = sessionmaker(bind=engine)
-    session = Session()
+@dataclass(frozen=True)
+class ScenarioRows:
+    pots: tuple[Pot, ...]
+    incomes: tuple[Income, ...]
+    parameters: Parameters | None
+    loaded: float
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+class ScenarioCache:
+    """Read-through LRU of each cashflow's rows, dropped after ttl seconds or on a write."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.rows: OrderedDict[int, ScenarioRows] = OrderedDict()
+        # bumped by every invalidation, so a read that overlaps a write doesn't cache what it read before it
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, cashflow_id) -> ScenarioRows:
+        with self.lock:
+            rows = self.rows.get(cashflow_id)
+            if rows is not None and time.monotonic() - rows.loaded < self.ttl:
+                self.rows.move_to_end(cashflow_id)
+                self.hits += 1
+                return rows
+            self.misses += 1
+            generation = self.generation
+
+        rows = load_scenario_rows(cashflow_id)
+        with self.lock:
+            if generation == self.generation:
+                self.rows[cashflow_id] = rows
+                self.rows.move_to_end(cashflow_id)
+                while len(self.rows) > self.maxsize:
+                    self.rows.popitem(last=False)
+        return rows
+
+    def invalidate(self, *cashflow_ids):
+        with self.lock:
+            self.generation += 1
+            for cashflow_id in cashflow_ids:
+                self.rows.pop(cashflow_id, None)
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.rows))
+
+    def cache_clear(self):
+        with self.lock:
+            self.generation += 1
+            self.rows.clear()
+            self.hits = self.misses = 0
+
+def load_scenario_rows(cashflow_id) -> ScenarioRows:
+    with db_session() as session:
+        pots = session.scalars(select(Pot)
+                               .where(Pot.cashflow_id == cashflow_id)
+                               .order_by(Pot.pot_id)).all()
+        incomes = session.scalars(select(Income)
+                                  .where(Income.cashflow_id == cashflow_id)
+                                  .order_by(Income.income_id)).all()
+        parameters = session.get(Parameters, cashflow_id)
+    logger.debug("Read cashflow %s: %s pots, %s incomes", cashflow_id, len(pots), len(incomes))
 
-    pot = session.query(Pot).get(pot_id)
-    logger.info(pot)
+    return ScenarioRows(tuple(pots), tuple(incomes), parameters, time.monotonic())
+
+def read_pot(pot_id, cashflow_id=None) -> Pot:
+    # through the cashflow's cached rows when the caller knows which cashflow it is after
+    if cashflow_id is not None:
+        return next((p for p in scenario_cache.get(cashflow_id).pots if p.pot_id == pot_id), None)
+
+    with db_session() as session:
+        pot = session.get(Pot, pot_id)
+    logger.debug("Read pot %s", pot)
 
     return pot
 
+def read_pots(cashflow_id) -> list[Pot]:
+    return list(scenario_cache.get(cashflow_id).pots)
+
+class ScenarioNotFound(LookupError):
+    pass
+
 def update_pot(pots):
-    engine = create_engine(db.get_connection_string())
-    Session = sessionmaker(bind=engine)
-    session = Session()
     dbpots = []
     for p in pots:
            dbpots.append({"pot_id": p.pot_id,
+                         "cashflow_id": p.cashflow_id,
                          "name": p.name,
                          "type": p.type,
                           "amount": p.amount})
 
-    result = session.execute(
-        update(Pot),
-        dbpots,
-    )
-    session.commit()
+    with db_session() as session:
+        # only pots of the cashflow given, which is then the one whose cached rows are stale
+        for row in dbpots:
+            result = session.execute(
+                update(Pot)
+                .where(Pot.pot_id == row["pot_id"], Pot.cashflow_id == row["cashflow_id"])
+                .values(row)
+            )
+            if result.rowcount != 1:
+                # rolled back when the session closes, so none of them are saved
+                raise ScenarioNotFound(f"Cashflow {row['cashflow_id']} has no pot {row['pot_id']}")
+        session.commit()
+    scenario_cache.invalidate(*{p.cashflow_id for p in pots})
 
-def read_income(income_id) -> Income:
-    engine = create_engine(db.get_connection_string())
-    Session = sessionmaker(bind=engine)
-    session = Session()
+def read_income(income_id, cashflow_id=None) -> Income:
+    if cashflow_id is not None:
+        return next((i for i in scenario_cache.get(cashflow_id).incomes if i.income_id == income_id), None)
 
-    income = session.query(Income).get(income_id)
+    with db_session() as session:
+        income = session.get(Income, income_id)
 
-    logger.info(income)
+    logger.debug("Read income %s", income)
 
     return income
 
+def read_incomes(cashflow_id) -> list[Income]:
+    return list(scenario_cache.get(cashflow_id).incomes)
+
 def update_income(incomes):
-    engine = create_engine(db.get_connection_string())
-    Session = sessionmaker(bind=engine)
-    session = Session()
     dbincomes = []
     for i in incomes:
            dbincomes.append({"income_id": i.income_id,
+                         "cashflow_id": i.cashflow_id,
                          "name": i.name,
                          "type": i.type,
                           "amount": i.amount,
@@ -126,26 +229,22 @@ def update_income(incomes):
                           "start_date": i.start_date
                              })
 
-    result = session.execute(
-        update(Income),
-        dbincomes,
-    )
-    session.commit()
+    with db_session() as session:
+        for row in dbincomes:
+            result = session.execute(
+                update(Income)
+                .where(Income.income_id == row["income_id"], Income.cashflow_id == row["cashflow_id"])
+                .values(row)
+            )
+            if result.rowcount != 1:
+                raise ScenarioNotFound(f"Cashflow {row['cashflow_id']} has no income {row['income_id']}")
+        session.commit()
+    scenario_cache.invalidate(*{i.cashflow_id for i in incomes})
 
 def read_parameters(cashflow_id) -> Parameters:
-    engine = create_engine(db.get_connection_string())
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
-    parameters = session.query(Parameters).get(cashflow_id)
-
-    logger.info("Updating parameters")
-    return parameters
+    return scenario_cache.get(cashflow_id).parameters
 
 def update_parameters(parameters):
-    engine = create_engine(db.get_connection_string())
-    Session = sessionmaker(bind=engine)
-    session = Session()
     dbparams = []
     for p in parameters:
         dbparams.append({"cashflow_id": p.cashflow_id,
@@ -160,12 +259,52 @@ def update_parameters(parameters):
                           "charges": p.charges
                              })
 
-    result = session.execute(
-        update(Parameters),
-        dbparams,
-    )
-    session.commit()
+    with db_session() as session:
+        session.execute(
+            update(Parameters),
+            dbparams,
+        )
+        session.commit()
+    scenario_cache.invalidate(*{p.cashflow_id for p in parameters})
+
+def update_scenario(cashflow_id, pots: list[dict], incomes: list[dict], parameters: dict):
+    """
+    Apply changes to a cashflow's pots, incomes and parameters in one
+    transaction: all of them, or none if any row isn't the cashflow's.
+    """
+    try:
+        with db_session() as session, session.begin():
+            for table, key, rows in ((Pot, Pot.pot_id, pots), (Income, Income.income_id, incomes)):
+                for row in rows:
+                    changes = {k: v for k, v in row.items() if k != key.key}
+                    result = session.execute(update(table)
+                                             .where(key == row[key.key], table.cashflow_id == cashflow_id)
+                                             .values(changes or {key.key: row[key.key]}))
+                    if result.rowcount != 1:
+                        raise ScenarioNotFound(f"Cashflow {cashflow_id} has no {table.__tablename__[:-1]} {row[key.key]}")
+            if parameters:
+                result = session.execute(update(Parameters)
+                                         .where(Parameters.cashflow_id == cashflow_id)
+                                         .values(parameters))
+                if result.rowcount != 1:
+                    raise ScenarioNotFound(f"Cashflow {cashflow_id} not found")
+    finally:
+        scenario_cache.invalidate(cashflow_id)
+
+def ensure_indexes():
+    # the tables predate the cashflow_id indexes, create_all would skip them
+    engine = database().get_engine()
+    try:
+        for table in (Pot.__table__, Income.__table__):
+            for index in table.indexes:
+                index.create(bind=engine, checkfirst=True)
+    except SQLAlchemyError as e:
+        logger.warning(f"Could not create cashflow indexes: {e}")
 
 logger = logging.getLogger('cashflow')
-db = DB()
+Session = sessionmaker()
+scenario_cache = track_cache(ScenarioCache(ENV().scenario_cache_size, ENV().scenario_cache_ttl), 'app.dao.scenario_cache')
 
+def db_session():
+    # bound on use so importing the app doesn't need a database configured
+    return Session(bind=database().get_engine())
@@ -0,0 +1,338 @@
+from __future__ import annotations as _annotations
+
+import datetime as dt
+import logging
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Sequence
+
+import numpy as np
+from dateutil.relativedelta import relativedelta
+
+from .closes import UnknownTicker
+from .market import stock_returns
+from .metrics import span, track_cache
+from .portfolio import Portfolio, check_market, portfolio_returns, sampled_portfolio_paths
+
+logger = logging.getLogger('cashflow')
+
+'''
+# Cashflow engine
+======================================================================
+Each stage is memoised on only the inputs it depends on, so editing one
+pot, income or parameter only recomputes the stages downstream of it:
+
+    inflation_factors(inflation, years)
+      -> income_schedule(amount, years_in, inflation, years)
+      -> required_income(target_income, inflation, years)
+    return_path(growth, ticker, historical_start_year, years)  -- or a portfolio, see portfolio.py
+    project(scenario)  -- the drawdown, keyed on the whole Scenario
+    simulate(scenarios)  -- many scenarios in one drawdown, outcomes only
+    sampled_paths(ticker, years, count)  -- bootstrapped Monte Carlo return paths, not cached
+
+Cached arrays are read-only; copy before modifying them.
+'''
+
+
+class NotEnoughHistory(UnknownTicker):
+    pass
+
+
+@dataclass(frozen=True)
+class PotInput:
+    label: str
+    amount: float
+
+
+@dataclass(frozen=True)
+class IncomeInput:
+    label: str
+    amount: float
+    years_in: int
+
+
+@dataclass(frozen=True)
+class Scenario:
+    pots: tuple[PotInput, ...]
+    incomes: tuple[IncomeInput, ...]
+    target_income: float
+    inflation: float
+    growth: float
+    charges: float
+    retirement_age: int
+    years: int
+    ticker: str
+    historical_start_year: int
+    pot_start_date: dt.date
+
+
+@dataclass(frozen=True)
+class Projection:
+    scenario: Scenario
+    pot_labels: tuple[str, ...]    # in drawdown order, smallest pot first
+    amounts: np.ndarray            # (pots, years) balance at the start of each year
+    spent: np.ndarray              # (pots, years) taken from each pot
+    income_labels: tuple[str, ...]
+    incomes: np.ndarray            # (incomes, years)
+    required: np.ndarray           # (years,) target income with inflation
+    drawn_down: np.ndarray         # (years,) total taken from the pots
+    growth: np.ndarray             # (years,) growth multiplier applied to the pots
+    ages: np.ndarray               # (years,)
+
+
+@dataclass(frozen=True)
+class Outcome:
+    # (scenarios,), or (scenarios, paths) when run against sampled paths
+    success: np.ndarray            # the need was met every year
+    final_balance: np.ndarray      # left in the pots in the last year
+    shortfall: np.ndarray          # total need left unmet
+
+
+# pounds of unmet need that still count as met, float residue from splitting a year across pots
+SHORTFALL_TOLERANCE = 0.01
+# paths x years one sampled_paths() call may draw, 96MB of float64
+MAX_SAMPLED_VALUES = 12_000_000
+
+
+def frozen(a: np.ndarray) -> np.ndarray:
+    a.flags.writeable = False
+    return a
+
+
+@lru_cache(maxsize=256)
+def inflation_factors(inflation: float, years: int) -> np.ndarray:
+    cpi = inflation / 100
+    return frozen((1 + cpi) ** np.arange(years))
+
+
+@lru_cache(maxsize=1024)
+def income_schedule(amount: float, years_in: int, inflation: float, years: int) -> np.ndarray:
+    # compound interest  p * (( (1 + i)**n) - 1 )
+    # paid from the year after it starts
+    factors = inflation_factors(inflation, years)
+    return frozen(np.where(np.arange(years) > years_in, amount + (amount * (factors - 1)), 0.0))
+
+
+@lru_cache(maxsize=256)
+def required_income(target_income: float, inflation: float, years: int) -> np.ndarray:
+    factors = inflation_factors(inflation, years)
+    return frozen(target_income + (target_income * (factors - 1)))
+
+
+@lru_cache(maxsize=256)
+def return_path(growth: float, ticker: str, historical_start_year: int, years: int) -> np.ndarray:
+    if growth > 0:
+        return frozen(np.full(years, (100 + growth) / 100))
+
+    portfolio = Portfolio.parse(ticker)
+    if not portfolio.single:
+        return portfolio_returns(portfolio, historical_start_year, years)
+
+    stock = stock_returns()
+    stock.get_data([ticker])
+    return frozen(np.array(stock.get_yearly_returns(start=historical_start_year,
+                                                    ticker=ticker, years=years), dtype=float))
+
+
+def yearly_limit(amount: float) -> float:
+    return 1000000 if amount > 100000 else 12750
+
+
+@span('drawdown')
+def drawdown(start: np.ndarray, limits: np.ndarray, need: np.ndarray, growth: np.ndarray,
+             charges: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Draw the yearly need from each pot in turn, then grow what is left.
+
+    start and limits are (scenarios, pots) with pots in drawdown order; need and
+    growth are (scenarios, years); charges is (scenarios,) in percent. Returns
+    the balances and amounts spent, both (scenarios, pots, years), and the need
+    left unmet each year (scenarios, years).
+    """
+    scenarios, pots = start.shape
+    years = need.shape[1]
+
+    amounts = np.repeat(start[:, :, np.newaxis], years, axis=2).astype(float)
+    spent = np.zeros((scenarios, pots, years))
+    remaining = np.array(need, dtype=float)
+    charge = (charges / 100)
+
+    for y in range(years - 1):
+        for p in range(pots):
+            available = amounts[:, p, y]
+            request = np.where(remaining[:, y] > limits[:, p], limits[:, p], remaining[:, y])
+            # a negative request (income above target) pays the surplus into the pot
+            w = np.where(available >= request, request, np.maximum(available, 0))
+            w = np.where(available > 0, w, 0)
+
+            left = (available - w) * growth[:, y]
+            amounts[:, p, y + 1] = left - (charge * left)
+            remaining[:, y] = remaining[:, y] - w
+            spent[:, p, y] = w
+
+    return amounts, spent, remaining
+
+
+@lru_cache(maxsize=128)
+def project(scenario: Scenario) -> Projection:
+    years = scenario.years
+
+    incomes = np.array([income_schedule(i.amount, i.years_in, scenario.inflation, years)
+                        for i in scenario.incomes]).reshape(len(scenario.incomes), years)
+    required = required_income(scenario.target_income, scenario.inflation, years)
+    growth = return_path(scenario.growth, scenario.ticker, scenario.historical_start_year, years)
+
+    # Sort pots to take from the smallest one first
+    order = sorted(range(len(scenario.pots)), key=lambda p: scenario.pots[p].amount)
+    pots = [scenario.pots[p] for p in order]
+    start = np.array([[p.amount for p in pots]], dtype=float)
+    limits = np.array([[yearly_limit(p.amount) for p in pots]], dtype=float)
+
+    need = required - incomes.sum(axis=0)
+    amounts, spent, remaining = drawdown(start, limits, need[np.newaxis, :], growth[np.newaxis, :],
+                                         np.array([scenario.charges], dtype=float))
+
+    return Projection(
+        scenario=scenario,
+        pot_labels=tuple(p.label for p in pots),
+        amounts=frozen(amounts[0]),
+        spent=frozen(spent[0]),
+        income_labels=tuple(i.label for i in scenario.incomes),
+        incomes=frozen(incomes),
+        required=required,
+        drawn_down=frozen(need - remaining[0]),
+        growth=growth,
+        ages=frozen(scenario.retirement_age + np.arange(years)),
+    )
+
+
+def scenario_need(scenario: Scenario) -> np.ndarray:
+    need = required_income(scenario.target_income, scenario.inflation, scenario.years).copy()
+    for i in scenario.incomes:
+        need -= income_schedule(i.amount, i.years_in, scenario.inflation, scenario.years)
+    return need
+
+
+def return_paths(scenarios: Sequence[Scenario], years: int) -> np.ndarray:
+    """(scenarios, years) return paths, NotEnoughHistory if a window runs past the returns history."""
+    paths = {}
+    for s in scenarios:
+        key = (s.growth, s.ticker, s.historical_start_year)
+        if key not in paths:
+            path = return_path(*key, years)
+            if len(path) < years or np.isnan(path).any():
+                raise NotEnoughHistory(f"Not enough {s.ticker} history for {years} years "
+                                       f"from {s.historical_start_year}")
+            paths[key] = path
+    return np.array([paths[(s.growth, s.ticker, s.historical_start_year)] for s in scenarios])
+
+
+def simulate(scenarios: Sequence[Scenario], paths: np.ndarray | None = None) -> Outcome:
+    """
+    Run many scenarios through one batched drawdown. The scenarios must share
+    their pots and number of years. Each scenario uses its own return path,
+    or with paths (paths, years) every scenario is run against every path and
+    the outcomes are (scenarios, paths).
+    """
+    first = scenarios[0]
+    years = first.years
+    pots = sorted(first.pots, key=lambda p: p.amount)
+    if any(s.pots != first.pots or s.years != years for s in scenarios):
+        raise ValueError('simulate() needs scenarios with the same pots and years')
+
+    # grids repeat the same need many times over
+    needs = {}
+    for s in scenarios:
+        key = (s.target_income, s.inflation, s.incomes)
+        if key not in needs:
+            needs[key] = scenario_need(s)
+    need = np.array([needs[(s.target_income, s.inflation, s.incomes)] for s in scenarios])
+    charges = np.array([s.charges for s in scenarios], dtype=float)
+
+    if paths is None:
+        # any tickers not fetched yet are downloaded together
+        stock_returns().get_data({ticker for s in scenarios if s.growth <= 0
+                                  for ticker in Portfolio.parse(s.ticker).tickers})
+        growth = return_paths(scenarios, years)
+        shape = (len(scenarios),)
+    else:
+        growth = np.tile(paths, (len(scenarios), 1))
+        need = np.repeat(need, len(paths), axis=0)
+        charges = np.repeat(charges, len(paths))
+        shape = (len(scenarios), len(paths))
+
+    count = len(need)
+    start = np.tile(np.array([p.amount for p in pots], dtype=float), (count, 1))
+    limits = np.tile(np.array([yearly_limit(p.amount) for p in pots], dtype=float), (count, 1))
+
+    amounts, _, remaining = drawdown(start, limits, need, growth, charges)
+
+    # the last year is never drawn down, see drawdown()
+    unmet = np.maximum(remaining[:, :-1], 0)
+    return Outcome(
+        success=(unmet <= SHORTFALL_TOLERANCE).all(axis=1).reshape(shape),
+        final_balance=amounts[:, :, -1].sum(axis=1).reshape(shape),
+        shortfall=unmet.sum(axis=1).reshape(shape),
+    )
+
+
+def sampled_paths(ticker: str, years: int, count: int, seed: int = 0) -> np.ndarray:
+    """
+    (count, years) return paths drawn year by year, with replacement, from
+    every yearly return in the ticker's history. Not cached: count and seed
+    come from the request, so callers keep the paths for as long as they run.
+    """
+    if count * years > MAX_SAMPLED_VALUES:
+        raise ValueError(f"{count} paths of {years} years is more than the {MAX_SAMPLED_VALUES:,} "
+                         f"returns one run can sample")
+    portfolio = Portfolio.parse(ticker)
+    if not portfolio.single:
+        return sampled_portfolio_paths(portfolio, years, count, seed)
+
+    stock = stock_returns()
+    stock.get_data([ticker])
+    history = np.array(stock.get_yearly_returns(start=stock.start, ticker=ticker,
+                                                years=int(stock.end) - int(stock.start)), dtype=float)
+    history = history[~np.isnan(history)]
+    if not len(history):
+        raise ValueError(f"No {ticker} history to sample from")
+    rng = np.random.default_rng(seed)
+    return frozen(rng.choice(history, size=(count, years)))
+
+
+def pot_start(age: int, retirement_age: int, today: dt.date | None = None) -> dt.date:
+    today = today or dt.datetime.now().date()
+    return today + relativedelta(years=(retirement_age - age))
+
+
+def build_scenario(potparams, incomeparams, params, today: dt.date | None = None) -> Scenario:
+    """Scenario from the pot, income and parameter form models."""
+    if params.growth <= 0:
+        check_market(params.ticker)
+    pot_start_date = pot_start(params.age, params.retirement_age, today)
+    logger.debug("age now %s, retirement start %s, pot_start_date %s", params.age, params.retirement_age, pot_start_date)
+
+    incomes = []
+    for i in incomeparams:
+        delta_date = i.start_date - pot_start_date
+        years_in = round(delta_date.days/365)
+        incomes.append(IncomeInput(label=i.name + ' ' + i.type, amount=i.amount, years_in=years_in))
+
+    return Scenario(
+        pots=tuple(PotInput(label=p.name, amount=p.amount) for p in potparams),
+        incomes=tuple(incomes),
+        target_income=params.target_income,
+        inflation=params.inflation,
+        growth=params.growth,
+        charges=params.charges,
+        retirement_age=params.retirement_age,
+        years=params.years,
+        ticker=params.ticker,
+        historical_start_year=params.historical_start_year,
+        pot_start_date=pot_start_date,
+    )
+
+
+CACHES = (inflation_factors, income_schedule, required_income, return_path, project)
+for cache in CACHES:
+    track_cache(cache)
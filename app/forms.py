@@ -2,23 +2,26 @@ from __future__ import annotations as _annotations
 
 import enum
 import re
-from collections import defaultdict
 from datetime import date
-from typing import Annotated, Literal, TypeAlias
+from typing import Annotated, TypeAlias
 from dataclasses import dataclass
+from functools import lru_cache
 
-from fastapi import APIRouter, Request, UploadFile
+from fastapi import APIRouter, HTTPException, Path, Request, UploadFile
+from fastapi.responses import Response
 from fastui import AnyComponent, FastUI
 from fastui import components as c
 from fastui.events import GoToEvent, PageEvent
 from fastui.forms import FormFile, SelectSearchResponse, fastui_form
-from httpx import AsyncClient
 from pydantic import BaseModel, EmailStr, Field, SecretStr, field_validator
+from pydantic.json_schema import SkipJsonSchema
 from pydantic_core import PydanticCustomError
 
-from .shared import demo_page
-from .dao import read_pot, update_pot, read_income, update_income, read_parameters, update_parameters
+from .shared import demo_page_response, dump_component
+from .dao import ScenarioNotFound, read_pot, read_pots, update_pot, read_income, read_incomes, update_income, read_parameters, update_parameters
 from .env import ENV
+from .cities import country_index
+from .metrics import track_cache
 import logging
 
 
@@ -43,114 +46,72 @@ router = APIRouter()
 
 @router.get('/search', response_model=SelectSearchResponse)
 async def search_view(request: Request, q: str) -> SelectSearchResponse:
-    path_ends = f'name/{q}' if q else 'all'
-    client: AsyncClient = request.app.state.httpx_client
-    r = await client.get(f'https://restcountries.com/v3.1/{path_ends}')
-    if r.status_code == 404:
-        options = []
-    else:
-        r.raise_for_status()
-        data = r.json()
-        if path_ends == 'all':
-            # if we got all, filter to the 20 most populous countries
-            data.sort(key=lambda x: x['population'], reverse=True)
-            data = data[0:20]
-            data.sort(key=lambda x: x['name']['common'])
-
-        regions = defaultdict(list)
-        for co in data:
-            regions[co['region']].append({'value': co['cca3'], 'label': co['name']['common']})
-        options = [{'label': k, 'options': v} for k, v in regions.items()]
+    # an empty query gives the 20 most populous countries
+    options = country_index().search(q)
     return SelectSearchResponse(options=options)
 
 
-FormKind: TypeAlias = Literal['login', 'select', 'big', 'pot1','pot2','pot3','pot4','pot5', 'income1','income2','income3','income4','cashflow','parameters']
+FormKind: TypeAlias = Annotated[str, Path(pattern=r'^(login|select|big|cashflow|parameters|pot\d+|income\d+)$')]
 
 
-@router.get('/{kind}', response_model=FastUI, response_model_exclude_none=True)
-def forms_view(kind: FormKind) -> list[AnyComponent]:
-    #links=[]
+def forms_base(cashflow_id: int) -> str:
+    # cashflow 1 keeps the original /forms/{kind} urls
+    return '/forms' if cashflow_id == 1 else f'/forms/{cashflow_id}'
+
+
+def form_link(text: str, kind: str, cashflow_id: int = 1) -> c.Link:
+    base = forms_base(cashflow_id)
+    return c.Link(
+        components=[c.Text(text=text)],
+        on_click=PageEvent(name='change-form', push_path=f'{base}/{kind}', context={'kind': kind}),
+        active=f'{base}/{kind}',
+    )
 
+
+@track_cache
+@lru_cache(maxsize=1024)
+def form_tabs(cashflow_id: int, pots: tuple[tuple[int, str], ...], incomes: tuple[tuple[int, str], ...]) -> bytes:
+    # only depends on ENV and the cashflow's pot and income names, so build and serialise it once
     pot_names=env.cashflow_tabs
     income_names=env.cashflow_incomes
 
-    links=[
-                c.Link(
-                    components=[c.Text(text='Chart')],
-                    on_click=PageEvent(name='change-form', push_path='/forms/cashflow', context={'kind': 'cashflow'}),
-                    active='/forms/cashflow',
-                )]
-    links.append(
-                c.Link(
-                    components=[c.Text(text=pot_names[0])],
-                    on_click=PageEvent(name='change-form', push_path='/forms/pot1', context={'kind': 'pot1'}),
-                    active='/forms/pot1',
-                ))
-    links.append(
-                c.Link(
-                    components=[c.Text(text=pot_names[1])],
-                    on_click=PageEvent(name='change-form', push_path='/forms/pot2', context={'kind': 'pot2'}),
-                    active='/forms/pot2',
-                ))
-    links.append(
-                c.Link(
-                    components=[c.Text(text=pot_names[2])],
-                    on_click=PageEvent(name='change-form', push_path='/forms/pot3', context={'kind': 'pot3'}),
-                    active='/forms/pot3',
-                ))
-    links.append(
-                c.Link(
-                    components=[c.Text(text=pot_names[3])],
-                    on_click=PageEvent(name='change-form', push_path='/forms/pot4', context={'kind': 'pot4'}),
-                    active='/forms/pot4',
-                ))
-    links.append(
-                c.Link(
-                    components=[c.Text(text=income_names[0])],
-                    on_click=PageEvent(name='change-form', push_path='/forms/income1', context={'kind': 'income1'}),
-                    active='/forms/income1',
-                ))
-    links.append(
-                c.Link(
-                    components=[c.Text(text=income_names[1])],
-                    on_click=PageEvent(name='change-form', push_path='/forms/income2', context={'kind': 'income2'}),
-                    active='/forms/income2',
-                ))
-    links.append(
-                c.Link(
-                    components=[c.Text(text=income_names[2])],
-                    on_click=PageEvent(name='change-form', push_path='/forms/income3', context={'kind': 'income3'}),
-                    active='/forms/income3',
-                ))
-    links.append(
-                c.Link(
-                    components=[c.Text(text=income_names[3])],
-                    on_click=PageEvent(name='change-form', push_path='/forms/income4', context={'kind': 'income4'}),
-                    active='/forms/income4',
-                ))
-    links.append(
-                c.Link(
-                    components=[c.Text(text='Parameters')],
-                    on_click=PageEvent(name='change-form', push_path='/forms/parameters', context={'kind': 'parameters'}),
-                    active='/forms/parameters',
-                ))
-
-    return demo_page(
+    links = [form_link('Chart', 'cashflow', cashflow_id)]
+    links += [form_link(pot_names[n] if n < len(pot_names) else name, f'pot{pot_id}', cashflow_id)
+              for n, (pot_id, name) in enumerate(pots)]
+    links += [form_link(income_names[n] if n < len(income_names) else name, f'income{income_id}', cashflow_id)
+              for n, (income_id, name) in enumerate(incomes)]
+    links.append(form_link('Parameters', 'parameters', cashflow_id))
+
+    return dump_component(
         c.LinkList(links=links,
             mode='tabs',
             class_name='+ mb-4',
-        ),
+        ))
+
+
+@router.get('/{cashflow_id:int}/{kind}', response_model=FastUI, response_model_exclude_none=True)
+def cashflow_forms_view(cashflow_id: int, kind: FormKind) -> Response:
+    pots = tuple((p.pot_id, p.name) for p in read_pots(cashflow_id))
+    incomes = tuple((i.income_id, i.name) for i in read_incomes(cashflow_id))
+
+    return demo_page_response(
+        form_tabs(cashflow_id, pots, incomes),
         c.ServerLoad(
-            path='/forms/content/{kind}',
+            path=f'{forms_base(cashflow_id)}/content/{{kind}}',
             load_trigger=PageEvent(name='change-form'),
-            components=form_content(kind),
+            components=cashflow_form_content(cashflow_id, kind),
         ),
         title='Cashflow',
     )
 
 
-@router.get('/content/{kind}', response_model=FastUI, response_model_exclude_none=True)
-def form_content(kind: FormKind):
+@router.get('/{kind}', response_model=FastUI, response_model_exclude_none=True)
+def forms_view(kind: FormKind) -> Response:
+    return cashflow_forms_view(1, kind)
+
+
+@router.get('/{cashflow_id:int}/content/{kind}', response_model=FastUI, response_model_exclude_none=True)
+def cashflow_form_content(cashflow_id: int, kind: FormKind):
     match RegexEqual(kind):
         case "login":
             return [
@@ -172,16 +133,18 @@ def form_content(kind: FormKind):
             ]
         case "cashflow":
             return [
-                c.Iframe(src='http://127.0.0.1/charts/cashflow',
+                c.Iframe(src=f'http://127.0.0.1/charts/cashflow/{cashflow_id}',
                          width=1300, height=800)
             ]
         case "^pot(.*$)" as capture:
 
             id=capture[1]
             dbpot=None
-            dbpot = read_pot(int(id))
+            dbpot = read_pot(int(id), cashflow_id)
+            if dbpot is None or dbpot.cashflow_id != cashflow_id:
+                raise HTTPException(status_code=404, detail=f'Pot {id} not found in cashflow {cashflow_id}')
             return [
-                c.ModelForm(model=PotModel, submit_url='/api/forms/pot',
+                c.ModelForm(model=PotForm, submit_url=f'/api{forms_base(cashflow_id)}/pot',
                             initial={'pot_id':dbpot.pot_id,
                                      'name':dbpot.name,
                                      'type':dbpot.type,
@@ -191,9 +154,11 @@ def form_content(kind: FormKind):
 
         case "^income(.*$)" as capture:
             id=capture[1]
-            dbincome = read_income(int(id))
+            dbincome = read_income(int(id), cashflow_id)
+            if dbincome is None or dbincome.cashflow_id != cashflow_id:
+                raise HTTPException(status_code=404, detail=f'Income {id} not found in cashflow {cashflow_id}')
             return [
-                c.ModelForm(model=IncomeModel, submit_url='/api/forms/income',
+                c.ModelForm(model=IncomeForm, submit_url=f'/api{forms_base(cashflow_id)}/income',
                             initial={'income_id':dbincome.income_id,
                            'name':dbincome.name,
                            'type':dbincome.type,
@@ -204,12 +169,12 @@ def form_content(kind: FormKind):
                            })
             ]
         case "parameters":
-            id = 1
-            dbp = read_parameters(int(id))
+            dbp = read_parameters(cashflow_id)
+            if dbp is None:
+                raise HTTPException(status_code=404, detail=f'Cashflow {cashflow_id} not found')
             return [
-                c.ModelForm(model=ParametersModel, submit_url='/api/forms/parameters',
+                c.ModelForm(model=ParametersForm, submit_url=f'/api{forms_base(cashflow_id)}/parameters',
                             initial={
-                           'cashflow_id':dbp.cashflow_id,
                            'target_income':dbp.target_income,
                            'inflation':dbp.inflation,
                            'growth':dbp.growth,
@@ -225,6 +190,11 @@ def form_content(kind: FormKind):
             raise ValueError(f'Invalid kind {kind!r}')
 
 
+@router.get('/content/{kind}', response_model=FastUI, response_model_exclude_none=True)
+def form_content(kind: FormKind):
+    return cashflow_form_content(1, kind)
+
+
 class LoginForm(BaseModel):
     email: EmailStr = Field(title='Email Address', description="Try 'x@y' to trigger server side validation")
     password: SecretStr
@@ -305,6 +275,7 @@ class PotEnum(str, enum.Enum):
 
 class PotModel(BaseModel):
     pot_id: int = Field(description='Id')
+    cashflow_id: int = Field(description='Cashflow ID',default=1)
     name: str = Field(description='Name of account holder'
     )
     type: str = Field(description='What type of account is this ?'
@@ -314,6 +285,7 @@ class PotModel(BaseModel):
 
 class IncomeModel(BaseModel):
     income_id: int = Field(description='Id')
+    cashflow_id: int = Field(description='Cashflow ID',default=1)
     name: str | None = Field(
         None, description='Name of account holder'
     )
@@ -329,6 +301,17 @@ class IncomeModel(BaseModel):
     )
     start_date: date = Field(title='Start Date', description='What date does this income start to pay out ?')
 
+# what the edit forms show and post: the cashflow comes from the url they post to, not a field
+
+class PotForm(PotModel):
+    cashflow_id: SkipJsonSchema[int] = 1
+
+class IncomeForm(IncomeModel):
+    cashflow_id: SkipJsonSchema[int] = 1
+
+class ParametersForm(ParametersModel):
+    cashflow_id: SkipJsonSchema[int] = 1
+
 class CashFlowModel(BaseModel):
     pot: PotModel
     income: IncomeModel
@@ -340,22 +323,38 @@ parameters_form = ParametersModel(cashflow_id=1,target_income=50000, inflation=3
 cashflow_form = CashFlowModel(pot=pot_form,income=income_form,parameters=parameters_form)
 
 
+def show_chart(cashflow_id: int) -> list[AnyComponent]:
+    return [c.FireEvent(event=PageEvent(name='change-form', push_path=f'{forms_base(cashflow_id)}/cashflow',
+                                        context={'kind': 'cashflow'}))]
+
+
 @router.post('/pot')
-async def pot_form_post(form: Annotated[PotModel, fastui_form(PotModel)]):
+async def pot_form_post(form: Annotated[PotForm, fastui_form(PotForm)]):
+    return await cashflow_pot_form_post(1, form)
+
+@router.post('/{cashflow_id:int}/pot')
+async def cashflow_pot_form_post(cashflow_id: int, form: Annotated[PotForm, fastui_form(PotForm)]):
     # write stuff to db
     cashflow_form.pot.name = form.name
     cashflow_form.pot.type = form.type
     cashflow_form.pot.amount = form.amount
     cashflow_form.pot.select_single = form.select_single
     pots = []
-    pots.append(PotModel(pot_id=form.pot_id,name = form.name, type = form.type, amount=form.amount))
+    pots.append(PotModel(pot_id=form.pot_id,cashflow_id=cashflow_id,name = form.name, type = form.type, amount=form.amount))
 
-    update_pot(pots)
+    try:
+        update_pot(pots)
+    except ScenarioNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
 
-    return [c.FireEvent(event=PageEvent(name='change-form', push_path='/forms/cashflow', context={'kind': 'cashflow'}))]
+    return show_chart(cashflow_id)
 
 @router.post('/income')
-async def income_form_post(form: Annotated[IncomeModel, fastui_form(IncomeModel)]):
+async def income_form_post(form: Annotated[IncomeForm, fastui_form(IncomeForm)]):
+    return await cashflow_income_form_post(1, form)
+
+@router.post('/{cashflow_id:int}/income')
+async def cashflow_income_form_post(cashflow_id: int, form: Annotated[IncomeForm, fastui_form(IncomeForm)]):
     # write stuff to db
     cashflow_form.income.name = form.name
     cashflow_form.income.type = form.type
@@ -364,19 +363,26 @@ async def income_form_post(form: Annotated[IncomeModel, fastui_form(IncomeModel)
     cashflow_form.income.repeating_yearly = form.repeating_yearly
     cashflow_form.income.start_date = form.start_date
     incomes=[]
-    incomes.append(IncomeModel(income_id=form.income_id,name = form.name,
+    incomes.append(IncomeModel(income_id=form.income_id,cashflow_id=cashflow_id,name = form.name,
                                type = form.type,
                                amount=form.amount,
                                inflation_yearly=form.inflation_yearly,
                                repeating_yearly=form.repeating_yearly,
                                start_date = form.start_date))
 
-    update_income(incomes)
+    try:
+        update_income(incomes)
+    except ScenarioNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
 
-    return [c.FireEvent(event=PageEvent(name='change-form', push_path='/forms/cashflow', context={'kind': 'cashflow'}))]
+    return show_chart(cashflow_id)
 
 @router.post('/parameters')
-async def parameters_form_post(form: Annotated[ParametersModel, fastui_form(ParametersModel)]):
+async def parameters_form_post(form: Annotated[ParametersForm, fastui_form(ParametersForm)]):
+    return await cashflow_parameters_form_post(1, form)
+
+@router.post('/{cashflow_id:int}/parameters')
+async def cashflow_parameters_form_post(cashflow_id: int, form: Annotated[ParametersForm, fastui_form(ParametersForm)]):
     # write stuff to db
     cashflow_form.parameters.target_income = form.target_income
     cashflow_form.parameters.inflation = form.inflation
@@ -385,7 +391,6 @@ async def parameters_form_post(form: Annotated[ParametersModel, fastui_form(Para
     cashflow_form.parameters.retirement_age = form.retirement_age
     cashflow_form.parameters.charges = form.charges
 
-    cashflow_id =1
     parameters=[]
     parameters.append(ParametersModel(cashflow_id=cashflow_id,
                                         target_income=form.target_income,
@@ -401,4 +406,4 @@ async def parameters_form_post(form: Annotated[ParametersModel, fastui_form(Para
 
     update_parameters(parameters)
 
-    return [c.FireEvent(event=PageEvent(name='change-form', push_path='/forms/cashflow', context={'kind': 'cashflow'}))]
+    return show_chart(cashflow_id)
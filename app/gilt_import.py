@@ -0,0 +1,251 @@
+from __future__ import annotations as _annotations
+
+import argparse
+import csv
+import io
+import logging
+import re
+import time
+from datetime import date, datetime
+from itertools import islice
+from typing import IO, Iterable, Iterator
+from xml.etree.ElementTree import iterparse
+
+from fastapi import APIRouter, UploadFile
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError, field_validator
+
+from app.env import database
+
+logger = logging.getLogger('cashflow')
+router = APIRouter()
+
+CHUNK_SIZE = 500
+
+# DMO reports use "07-Mar-2024" in CSV and "2024-03-07T00:00:00" in XML
+DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%d-%b-%Y', '%d %b %Y', '%d/%m/%Y')
+
+
+class GiltRecord(BaseModel):
+    """One row of a DMO gilts-in-issue style file, keyed by ISIN."""
+    isin_code: str = Field(min_length=12, max_length=12)
+    close_of_business_date: date | None = None
+    instrument_type: str | None = None
+    maturity_bracket: str | None = None
+    instrument_name: str | None = None
+    ticker: str | None = None
+    redemption_date: date | None = None
+    first_issue_date: date | None = None
+    dividend_dates: str | None = None
+    current_ex_div_date: date | None = None
+    total_amount_in_issue: float | None = None
+    total_amount_including_il_uplift: float | None = None
+    coupon: float | None = None
+    days_to_redemption: int | None = None
+    years_to_redemption: float | None = None
+    clean_price: float | None = None
+    dirty_price: float | None = None
+    tradeweb_yield: float | None = None
+    calculated_yield: float | None = None
+
+    @field_validator('*', mode='before')
+    @classmethod
+    def blank_to_none(cls, v):
+        if isinstance(v, str):
+            v = v.strip()
+            return v or None
+        return v
+
+    @field_validator('close_of_business_date', 'redemption_date', 'first_issue_date',
+                     'current_ex_div_date', mode='before')
+    @classmethod
+    def parse_date(cls, v):
+        if isinstance(v, str):
+            for fmt in DATE_FORMATS:
+                try:
+                    return datetime.strptime(v, fmt).date()
+                except ValueError:
+                    pass
+        return v
+
+    @field_validator('isin_code', mode='before')
+    @classmethod
+    def strip_isin(cls, v):
+        return v.replace(' ', '').upper() if isinstance(v, str) else v
+
+
+COLUMNS = tuple(GiltRecord.model_fields)
+records_adapter = TypeAdapter(list[GiltRecord])
+
+
+class GiltImportResult(BaseModel):
+    rows: int
+    rejected: int
+    inserted: int
+    updated: int
+    errors: list[str]
+    milliseconds: float
+
+
+def column_name(header: str) -> str | None:
+    # "ISIN Code" -> isin_code, "Total Amount in Issue (£ million nominal)" -> total_amount_in_issue
+    name = re.sub(r'[^a-z0-9]+', '_', header.strip().lower()).strip('_')
+    if name in COLUMNS:
+        return name
+    for column in sorted(COLUMNS, key=len, reverse=True):
+        if name.startswith(column + '_'):
+            return column
+    return None
+
+
+def read_csv(stream: IO[str]) -> Iterator[dict]:
+    reader = csv.reader(stream)
+    header = None
+    for line in reader:
+        if header is None:
+            # DMO downloads can have a title block above the real header
+            names = [column_name(cell) for cell in line]
+            if 'isin_code' in names:
+                header = names
+            continue
+        if any(cell.strip() for cell in line):
+            yield {name: value for name, value in zip(header, line) if name}
+
+
+def read_xml(stream: IO[bytes]) -> Iterator[dict]:
+    # rows are elements carrying the gilt columns as attributes or as child elements
+    for _, element in iterparse(stream, events=('end',)):
+        row = {}
+        for key, value in element.attrib.items():
+            if name := column_name(key):
+                row[name] = value
+        for child in element:
+            if len(child) == 0 and (name := column_name(child.tag)):
+                row[name] = child.text
+        if 'isin_code' in row:
+            yield row
+            element.clear()
+
+
+def read_rows(stream: IO[bytes], filename: str = '') -> Iterator[dict]:
+    head = stream.read(64)
+    stream.seek(0)
+    if filename.lower().endswith('.xml') or head.lstrip(b'\xef\xbb\xbf \r\n\t').startswith(b'<'):
+        return read_xml(stream)
+    return read_csv(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+
+
+def validated_chunks(rows: Iterable[dict], errors: list[str], chunk_size: int = CHUNK_SIZE) -> Iterator[list[GiltRecord]]:
+    rows = iter(rows)
+    offset = 0
+    while chunk := list(islice(rows, chunk_size)):
+        try:
+            yield records_adapter.validate_python(chunk)
+        except ValidationError:
+            # validate the chunk row by row so one bad line doesn't reject its neighbours
+            good = []
+            for n, row in enumerate(chunk, start=offset + 1):
+                try:
+                    good.append(GiltRecord.model_validate(row))
+                except ValidationError as e:
+                    errors.append(f"row {n}: {e.errors()[0]['loc']} {e.errors()[0]['msg']}")
+            yield good
+        offset += len(chunk)
+
+
+def copy_rows(cursor, table: str, columns: Iterable[str], rows: Iterable[tuple]) -> int:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    return count
+
+
+# a new gilt needs every column, gilts.PyGilt and the charts read them all; updates keep what they leave blank
+DROP_INCOMPLETE = f"""
+    DELETE FROM gilts_staging s
+    WHERE NOT EXISTS (SELECT 1 FROM gilts g WHERE g.isin_code = s.isin_code)
+      AND ({' OR '.join(f's.{c} IS NULL' for c in COLUMNS)})
+    RETURNING {', '.join(COLUMNS)}
+"""
+
+MERGE_GILTS = f"""
+    MERGE INTO gilts g
+    USING (SELECT DISTINCT ON (isin_code) * FROM gilts_staging
+           ORDER BY isin_code, close_of_business_date DESC NULLS LAST) s
+    ON g.isin_code = s.isin_code
+    WHEN MATCHED THEN UPDATE SET
+        {', '.join(f'{c} = COALESCE(s.{c}, g.{c})' for c in COLUMNS if c != 'isin_code')}
+    WHEN NOT MATCHED THEN INSERT ({', '.join(COLUMNS)})
+        VALUES ({', '.join(f's.{c}' for c in COLUMNS)})
+"""
+
+
+def import_gilts(stream: IO[bytes], filename: str = '', chunk_size: int = CHUNK_SIZE) -> GiltImportResult:
+    """
+    Stream a CSV or XML gilt file into the gilts table in one transaction:
+    validated chunks are COPYed into a temp staging table, then merged by ISIN.
+    Rows for ISINs not yet in the table are rejected unless every column is given.
+    """
+    start = time.perf_counter()
+    errors = []
+    rows = 0
+
+    connection = database().get_engine().raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"CREATE TEMP TABLE gilts_staging ON COMMIT DROP AS "
+                       f"SELECT {', '.join(COLUMNS)} FROM gilts WITH NO DATA")
+
+        for chunk in validated_chunks(read_rows(stream, filename), errors, chunk_size):
+            rows += copy_rows(cursor, 'gilts_staging', COLUMNS,
+                              (tuple(getattr(r, c) for c in COLUMNS) for r in chunk))
+
+        cursor.execute(DROP_INCOMPLETE)
+        for row in cursor.fetchall():
+            rows -= 1
+            errors.append(f"{row[0]}: a new gilt needs {', '.join(c for c, v in zip(COLUMNS, row) if v is None)}")
+
+        cursor.execute("SELECT count(DISTINCT s.isin_code), count(DISTINCT g.isin_code) "
+                       "FROM gilts_staging s LEFT JOIN gilts g ON g.isin_code = s.isin_code")
+        distinct, updated = cursor.fetchone()
+        cursor.execute(MERGE_GILTS)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+    result = GiltImportResult(rows=rows, rejected=len(errors), inserted=distinct - updated, updated=updated,
+                              errors=errors[:20], milliseconds=round((time.perf_counter() - start) * 1000, 1))
+    logger.info(f"Imported gilts: {result.rows} rows, {result.inserted} inserted, "
+                f"{result.updated} updated, {result.rejected} rejected in {result.milliseconds}ms")
+    return result
+
+
+@router.post('/import', response_model=GiltImportResult)
+def import_gilts_upload(file: UploadFile) -> GiltImportResult:
+    result = import_gilts(file.file, file.filename or '')
+    # yields feed the portfolios' bond sleeve
+    from .portfolio import clear_bond_caches
+    clear_bond_caches()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk load a DMO-style CSV or XML file of gilt reference data')
+    parser.add_argument('path')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    with open(args.path, 'rb') as f:
+        result = import_gilts(f, args.path, args.chunk_size)
+    print(result.model_dump_json(indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,31 +3,27 @@ from __future__ import annotations as _annotations
 from fastapi import APIRouter, Request
 from fastui import FastUI
 
-import matplotlib.pyplot as plt
-import base64
-import mpld3
-import matplotlib.colors
-from app.env import DB
+import hashlib
+from app.env import database
+from app.gilt_import import copy_rows
+from app.metrics import span
+from app.plotting import ImageFormat, MEDIA_TYPES, charting, figure_bytes, one_figure_at_a_time
+from app.shared import not_modified, validators
+from app.singleflight import SingleFlight
 from datetime import datetime, timedelta
+from functools import lru_cache
 from pydantic import BaseModel
-from sqlalchemy import Numeric, create_engine, Column, Integer, String, Date, Float
-from sqlalchemy import update
+from sqlalchemy import Numeric, Column, Integer, String, Date, Float
 from sqlalchemy import text
-from sqlalchemy.orm import DeclarativeBase, sessionmaker
+from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Session
 from fastapi import BackgroundTasks
-from fastapi.responses import HTMLResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, Response
 from fastapi.templating import Jinja2Templates
-import matplotlib
-import locale
-import pandas as pd
-import requests
 from io import StringIO
 import logging
 
-locale.setlocale(locale.LC_ALL, '')
-matplotlib.use("AGG")
-
 class Base(DeclarativeBase):
     pass
 
@@ -85,7 +81,6 @@ class Gilt(Base):
 
 
 logger = logging.getLogger('cashflow')
-db = DB()
 router = APIRouter()
 
 # app = FastAPI()
@@ -140,18 +135,16 @@ def last_refresh() -> datetime:
 
     last_refresh_time = datetime.now()
 
-    engine = create_engine(db.get_connection_string())
-    # Session = sessionmaker(bind=engine)
-    # session = Session()
+    engine = database().get_engine()
 
     t = text('select close_of_business_date from gilts \
             order by close_of_business_date desc limit 1')
 
-    connection = engine.connect()
-    rs = connection.execute(t)
+    with engine.connect() as connection:
+        rs = connection.execute(t)
 
-    for row in rs:
-        last_refresh_time = row.close_of_business_date
+        for row in rs:
+            last_refresh_time = row.close_of_business_date
 
     return last_refresh_time
 
@@ -180,7 +173,9 @@ def hover_table(ticker,instrument_name,clean_price,
     return table_html
 
 
-def create_image():
+@one_figure_at_a_time
+def create_image(fmt: ImageFormat | None = None):
+    """The yield curve as mpld3 HTML, or as a static image when fmt is given."""
     x = []
     y = []
     area = []
@@ -190,6 +185,9 @@ def create_image():
     alpha = []
     clean_price = []
 
+    plt, mpld3 = charting()
+    plt.rcParams["figure.autolayout"] = True
+
     gilts = generate_image_data()
 
     owned = ("TG24", "T25", "T27A", "TR25")
@@ -259,13 +257,18 @@ def create_image():
 
     legend.set_title("Price", prop={"size": 14})
 
+    if fmt:
+        with span('fig_to_image'):
+            return figure_bytes(fig, fmt)
+
     tooltip = mpld3.plugins.PointHTMLTooltip(
         scatter, labels=labels, hoffset=20, voffset=20, css=css
     )
 
     mpld3.plugins.connect(fig, tooltip)
 
-    html = mpld3.fig_to_html(fig)
+    with span('fig_to_html'):
+        html = mpld3.fig_to_html(fig)
 
     with open("static/temp.html", "w") as text_file:
         text_file.write(html)
@@ -274,86 +277,135 @@ def create_image():
 
 
 def generate_image_data():
-    plt.rcParams["figure.autolayout"] = True
-
-    engine = create_engine(db.get_connection_string())
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
-    gilts = (
-        session.query(Gilt)
-        .with_entities(
-            Gilt.instrument_name,
-            Gilt.ticker,
-            Gilt.redemption_date,
-            Gilt.years_to_redemption,
-            Gilt.calculated_yield,
-            Gilt.coupon,
-            Gilt.clean_price,
+    with Session(database().get_engine()) as session:
+        gilts = (
+            session.query(Gilt)
+            .with_entities(
+                Gilt.instrument_name,
+                Gilt.ticker,
+                Gilt.redemption_date,
+                Gilt.years_to_redemption,
+                Gilt.calculated_yield,
+                Gilt.coupon,
+                Gilt.clean_price,
+            )
+            .filter(Gilt.instrument_type.contains("%Conventional%"))
+            .all()
         )
-        .filter(Gilt.instrument_type.contains("%Conventional%"))
-        .all()
-    )
     return gilts
 
 
+class ChartVersion(BaseModel):
+    etag: str
+    last_refresh: datetime
+
+
+def chart_version() -> ChartVersion:
+    """
+    What the yield curve chart was drawn from: the last refresh date, plus
+    the prices and yields themselves as a refresh can land on the same date.
+    """
+    t = text('select max(close_of_business_date) as cob, count(*) as gilts, '
+             'sum(clean_price) as prices, sum(calculated_yield) as yields from gilts')
+    with database().get_engine().connect() as connection:
+        row = connection.execute(t).one()
+
+    cob = row.cob or datetime.now().date()
+    digest = hashlib.sha1(repr((cob, row.gilts, row.prices, row.yields)).encode()).hexdigest()[:20]
+    return ChartVersion(etag=f'gilts-{digest}', last_refresh=datetime.combine(cob, datetime.min.time()))
+
+
+@lru_cache(maxsize=4)
+def chart_html(etag: str) -> str:
+    # one render per version of the gilts table
+    return create_image()
+
+
+@lru_cache(maxsize=8)
+def chart_image(etag: str, fmt: ImageFormat) -> bytes:
+    return create_image(fmt)
+
+
+# /charts/gilts renders at most once per version however many ask at once
+image_flight = SingleFlight('gilts_image')
+
+
+async def gilts_chart(request: Request) -> Response:
+    version = await run_in_threadpool(chart_version)
+    headers = validators(version.etag, version.last_refresh)
+    if not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+
+    html = await image_flight.do(version.etag, chart_html, version.etag)
+    return HTMLResponse(html, headers=headers)
+
+
+async def gilts_chart_image(request: Request, fmt: ImageFormat) -> Response:
+    version = await run_in_threadpool(chart_version)
+    headers = validators(f'{version.etag}-{fmt}', version.last_refresh)
+    if not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+
+    image = await image_flight.do((version.etag, fmt), chart_image, version.etag, fmt)
+    return Response(image, media_type=MEDIA_TYPES[fmt], headers=headers)
+
+
 @router.get("/home", response_class=HTMLResponse)
 async def get_img(request: Request, background_tasks: BackgroundTasks):
-    html = create_image()
+    version = await run_in_threadpool(chart_version)
+    headers = validators(version.etag, version.last_refresh)
+    if not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
 
-    # b = base64.b64encode(bytes(html, 'utf-8')) # bytes
-    encoded = base64.b64encode(html.encode())
-    encoded_html = encoded.decode()
-
-    last_refresh_time = last_refresh().strftime('%A, %d %b %Y')
+    last_refresh_time = version.last_refresh.strftime('%A, %d %b %Y')
 
+    # the chart itself comes from /charts/gilts, which the browser revalidates with its own ETag
     return templates.TemplateResponse(
-            "image.html", {"request": request, "img": encoded_html,
-                           "last_refresh": last_refresh_time}
+            "image.html", {"request": request, "chart_url": f"/charts/gilts?v={version.etag}",
+                           "last_refresh": last_refresh_time}, headers=headers
     )
 
 
 def read_gilts():
-    engine = create_engine(db.get_connection_string())
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
-    gilts = (
-        session.query(Gilt)
-        .with_entities(
-            Gilt.gilt_id,
-            Gilt.close_of_business_date,
-            Gilt.instrument_type,
-            Gilt.maturity_bracket,
-            Gilt.instrument_name,
-            Gilt.isin_code,
-            Gilt.ticker,
-            Gilt.redemption_date,
-            Gilt.first_issue_date,
-            Gilt.dividend_dates,
-            Gilt.current_ex_div_date,
-            Gilt.total_amount_in_issue,
-            Gilt.total_amount_including_il_uplift,
-            Gilt.coupon,
-            Gilt.days_to_redemption,
-            Gilt.years_to_redemption,
-            Gilt.clean_price,
-            Gilt.dirty_price,
-            Gilt.tradeweb_yield,
-            Gilt.calculated_yield,
+    with Session(database().get_engine()) as session:
+        gilts = (
+            session.query(Gilt)
+            .with_entities(
+                Gilt.gilt_id,
+                Gilt.close_of_business_date,
+                Gilt.instrument_type,
+                Gilt.maturity_bracket,
+                Gilt.instrument_name,
+                Gilt.isin_code,
+                Gilt.ticker,
+                Gilt.redemption_date,
+                Gilt.first_issue_date,
+                Gilt.dividend_dates,
+                Gilt.current_ex_div_date,
+                Gilt.total_amount_in_issue,
+                Gilt.total_amount_including_il_uplift,
+                Gilt.coupon,
+                Gilt.days_to_redemption,
+                Gilt.years_to_redemption,
+                Gilt.clean_price,
+                Gilt.dirty_price,
+                Gilt.tradeweb_yield,
+                Gilt.calculated_yield,
+            )
+            .order_by(Gilt.coupon.desc())
+            .all()
         )
-        .order_by(Gilt.coupon.desc())
-        .all()
-    )
 
     return gilts
 
 def lookup_prices():
-
+    import pandas as pd
+    import requests
 
     hl_url = 'https://www.hl.co.uk/shares/corporate-bonds-gilts/bond-prices/uk-gilts'
 
-    r = requests.get(hl_url)
+    with span('gilt_price_fetch'):
+        r = requests.get(hl_url)
 
     logger.info(f"Looking up prices at {hl_url}")
 
@@ -375,69 +427,94 @@ def lookup_prices():
     return gilts
 
 
-@router.get("/update", response_model=FastUI, response_model_exclude_none=True)
-async def update_gilt_prices(request: Request, skip: int = 0, limit: int = 100):
-    engine = create_engine(db.get_connection_string())
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
-    dbgilts = (
-        session.query(Gilt)
-        .with_entities(
-            Gilt.gilt_id,
-            Gilt.isin_code
-        )
-        .filter(Gilt.instrument_type.contains("%Conventional%"))
-        .order_by(Gilt.coupon.desc())
-        .all()
-    )
+class PriceUpdateResult(BaseModel):
+    prices: int
+    matched: int
+    unmatched: int
+    changed: int
+
 
+@span('gilt_price_apply')
+def apply_prices(prices: dict, close_of_business_date: str) -> PriceUpdateResult:
+    """
+    Load scraped prices into a temp table with COPY and apply them to the
+    conventional gilts with a single UPDATE ... FROM, in one transaction.
+    """
+    connection = database().get_engine().raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("CREATE TEMP TABLE gilt_prices (isin_code varchar PRIMARY KEY, "
+                       "clean_price float, close_of_business_date date) ON COMMIT DROP")
+        loaded = copy_rows(cursor, 'gilt_prices', ('isin_code', 'clean_price', 'close_of_business_date'),
+                           ((isin, price, close_of_business_date) for isin, price in prices.items()
+                            if price == price))
+
+        cursor.execute("""
+            SELECT count(DISTINCT p.isin_code),
+                   count(*) FILTER (WHERE g.clean_price IS DISTINCT FROM p.clean_price)
+            FROM gilt_prices p JOIN gilts g ON g.isin_code = p.isin_code
+            WHERE g.instrument_type LIKE '%Conventional%'
+        """)
+        matched, changed = cursor.fetchone()
+
+        cursor.execute("""
+            UPDATE gilts g
+            SET clean_price = p.clean_price, close_of_business_date = p.close_of_business_date
+            FROM gilt_prices p
+            WHERE g.isin_code = p.isin_code AND g.instrument_type LIKE '%Conventional%'
+        """)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+    result = PriceUpdateResult(prices=loaded, matched=matched, unmatched=loaded - matched, changed=changed)
+    logger.info(f"Gilt prices applied: {result}")
+    return result
+
+
+update_flight = SingleFlight('gilts_update')
+
+
+def refresh_prices() -> tuple[PriceUpdateResult, str]:
     prices = lookup_prices()
 
     # Get Yesterday
     yesterday = datetime.now() - timedelta(1)
     close_of_business_date = yesterday.strftime('%Y-%m-%d')
 
-    gilts = []
-    for g in dbgilts:
-        if g.isin_code in prices:
-            gilts.append({"gilt_id": g.gilt_id,
-                          "close_of_business_date": close_of_business_date,
-                          "clean_price": prices[g.isin_code]})
+    result = apply_prices(prices, close_of_business_date)
 
-    result = session.execute(
-        update(Gilt),
-        gilts,
-    )
-    session.commit()
+    return result, last_refresh().strftime('%A, %d %b %Y')
 
-    for row in result:
-        logger.info(f"{row}")
 
-    last_refresh_time = last_refresh().strftime('%A, %d %b %Y')
+@router.get("/update", response_model=FastUI, response_model_exclude_none=True)
+async def update_gilt_prices(request: Request, skip: int = 0, limit: int = 100):
+    # one scrape and update however many clicks arrive while it runs
+    result, last_refresh_time = await update_flight.do('update', refresh_prices)
 
     return [
             { "text": f"Last time prices refreshed: {last_refresh_time}",
+         "type": "Paragraph" },
+            { "text": f"{result.matched} gilts matched, {result.unmatched} prices unmatched, "
+                      f"{result.changed} prices changed",
          "type": "Paragraph" }
             ]
 
 
 @router.get("/gilts/{gilt_id}", response_class=HTMLResponse)
 async def read_gilt(request: Request, gilt_id: int):
-    engine = create_engine(db.get_connection_string())
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
-    gilt = session.query(Gilt).get(gilt_id)
+    with Session(database().get_engine()) as session:
+        gilt = session.get(Gilt, gilt_id)
 
     return templates.TemplateResponse("gilt.html", {"request": request, "gilt": gilt})
 
 
 @router.post("/gilts")
 async def create_gilt(gilt: PyGilt):
-    engine = create_engine(db.get_connection_string())
-
-    with Session(engine) as session:
+    with Session(database().get_engine()) as session:
         g = Gilt(
             close_of_business_date=gilt.close_of_business_date,
             instrument_name=gilt.instrument_name,
@@ -460,8 +537,8 @@ async def create_gilt(gilt: PyGilt):
             calculated_yield=gilt.calculated_yield,
         )
 
-    session.add_all([g])
-    session.commit()
+        session.add_all([g])
+        session.commit()
     return gilt
 
 
@@ -0,0 +1,294 @@
+from __future__ import annotations as _annotations
+
+import logging
+import threading
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+from functools import cache
+from typing import Any, Callable, Literal, Protocol
+
+from fastapi import APIRouter, HTTPException, Response
+from fastapi.responses import HTMLResponse, JSONResponse
+from pydantic import BaseModel, Field, model_validator
+
+from .env import ENV
+from .simulations import make_run, summaries
+from .solver import MAX_PATHS, Mode, SolveFor
+
+logger = logging.getLogger('cashflow')
+router = APIRouter()
+
+'''
+# Jobs
+======================================================================
+Expensive runs submitted as jobs instead of being computed inside the
+request:
+
+    POST   /api/jobs                {"cashflow_id": 1, "kind": "monte_carlo", "paths": 50000}
+    GET    /api/jobs/{job_id}       status and progress
+    GET    /api/jobs/{job_id}/result
+    DELETE /api/jobs/{job_id}       cancel
+
+JOB_WORKERS threads take jobs from two queues, interactive before batch,
+and with more than one worker the first only takes interactive jobs, so a
+backlog of batch work can't hold up someone waiting on a page. At most
+JOB_QUEUE_SIZE jobs wait; past that, submissions get a 503. Chunked runs
+notice a cancel between chunks; the others finish, are marked cancelled
+and their result dropped.
+
+Jobs live in a JobStore. LocalJobStore keeps them in this process for
+JOB_TTL seconds after they finish, dropping expired ones on each submit
+and lookup; anything that can put and get a Job by id can stand in for
+it, e.g. a shared store once jobs run out of process.
+'''
+
+JobKind = Literal['cashflow', 'solve', 'monte_carlo', 'backtest', 'grid']
+Priority = Literal['interactive', 'batch']
+Status = Literal['queued', 'running', 'done', 'failed', 'cancelled']
+PRIORITIES: tuple[Priority, ...] = ('interactive', 'batch')
+
+
+class JobRequest(BaseModel):
+    cashflow_id: int = 1
+    kind: JobKind = 'monte_carlo'
+    priority: Priority = 'interactive'
+    # solve
+    solve_for: SolveFor = 'target_income'
+    mode: Mode = 'deterministic'
+    percentile: float = Field(default=90.0, gt=0, le=100)
+    historical_start_year: int | None = None
+    # solve in monte_carlo mode, and monte_carlo
+    paths: int = Field(default=10000, ge=10, le=200000)
+    seed: int = 0
+    # grid
+    x: str = 'target_income:30000:80000:51'
+    y: str = 'retirement_age:55:70:16'
+
+    @model_validator(mode='after')
+    def solver_paths(self):
+        # the solver runs every candidate against every path, so it takes far fewer than a monte_carlo run
+        if self.kind == 'solve' and self.mode == 'monte_carlo' and self.paths > MAX_PATHS:
+            raise ValueError(f"A solve samples at most {MAX_PATHS} paths")
+        return self
+
+
+class Job(BaseModel):
+    job_id: str
+    request: JobRequest
+    status: Status = 'queued'
+    submitted: datetime
+    started: datetime | None = None
+    finished: datetime | None = None
+    done: int = 0
+    total: int | None = None
+    error: str | None = None
+    # only returned by /result
+    result: Any = Field(default=None, exclude=True)
+
+
+class JobStore(Protocol):
+    def put(self, job: Job): ...
+
+    def get(self, job_id: str) -> Job | None: ...
+
+    def expire(self): ...
+
+
+class LocalJobStore:
+    """Jobs in this process, each kept for ttl seconds after it finishes."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.jobs: dict[str, Job] = {}
+        self.lock = threading.Lock()
+
+    def put(self, job: Job):
+        # copies both ways, as a store in another process would
+        with self.lock:
+            self.jobs[job.job_id] = job.model_copy()
+
+    def get(self, job_id: str) -> Job | None:
+        with self.lock:
+            job = self.jobs.get(job_id)
+        return job.model_copy() if job else None
+
+    def expire(self):
+        now = utcnow()
+        with self.lock:
+            for job_id in [job_id for job_id, job in self.jobs.items()
+                           if job.finished and (now - job.finished).total_seconds() > self.ttl]:
+                del self.jobs[job_id]
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class JobQueue:
+    def __init__(self, store: JobStore, workers: int, max_queued: int):
+        self.store = store
+        self.max_queued = max_queued
+        self.pending: dict[Priority, deque[str]] = {priority: deque() for priority in PRIORITIES}
+        self.ready = threading.Condition()
+        # set to cancel a job; only held while it is queued or running
+        self.cancels: dict[str, threading.Event] = {}
+        self.workers = [threading.Thread(target=self.work, args=(n == 0 and workers > 1,),
+                                         name=f'job-worker-{n}', daemon=True)
+                        for n in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, request: JobRequest) -> Job:
+        self.store.expire()
+        with self.ready:
+            if sum(len(queue) for queue in self.pending.values()) >= self.max_queued:
+                raise QueueFull()
+            job = Job(job_id=uuid.uuid4().hex, request=request, submitted=utcnow())
+            self.store.put(job)
+            self.cancels[job.job_id] = threading.Event()
+            self.pending[request.priority].append(job.job_id)
+            self.ready.notify_all()
+        logger.info(f"Queued {request.priority} {request.kind} job {job.job_id} for cashflow {request.cashflow_id}")
+        return job
+
+    def cancel(self, job_id: str) -> Job | None:
+        with self.ready:
+            job = self.store.get(job_id)
+            if job is None or job_id not in self.cancels:
+                return job
+            self.cancels[job_id].set()
+            if job_id in self.pending[job.request.priority]:
+                self.pending[job.request.priority].remove(job_id)
+                del self.cancels[job_id]
+                job.status, job.finished = 'cancelled', utcnow()
+                self.store.put(job)
+        return self.store.get(job_id)
+
+    def take(self, interactive_only: bool) -> str:
+        with self.ready:
+            while True:
+                for priority in PRIORITIES[:1] if interactive_only else PRIORITIES:
+                    if self.pending[priority]:
+                        return self.pending[priority].popleft()
+                self.ready.wait()
+
+    def work(self, interactive_only: bool):
+        while True:
+            job_id = self.take(interactive_only)
+            job = self.store.get(job_id)
+            cancelled = self.cancels.get(job_id)
+            if job is None or cancelled is None:
+                continue
+
+            def progress(done: int, total: int):
+                job.done, job.total = done, total
+                self.store.put(job)
+
+            try:
+                # cancelled between being taken off the queue and starting
+                if cancelled.is_set():
+                    raise JobCancelled()
+                job.status, job.started = 'running', utcnow()
+                self.store.put(job)
+                result = run_job(job.request, progress, cancelled)
+                # cashflow and solve jobs can't stop part way, so a cancel lands once they finish
+                if cancelled.is_set():
+                    raise JobCancelled()
+                job.result, job.status = result, 'done'
+            except JobCancelled:
+                job.status = 'cancelled'
+            except HTTPException as e:
+                job.status, job.error = 'failed', str(e.detail)
+            except ValueError as e:
+                job.status, job.error = 'failed', str(e)
+            except Exception as e:
+                logger.exception(f"Job {job_id} failed")
+                job.status, job.error = 'failed', repr(e)
+            finally:
+                job.finished = utcnow()
+                with self.ready:
+                    self.cancels.pop(job_id, None)
+                    self.store.put(job)
+            logger.info(f"{job.request.kind} job {job_id} {job.status}")
+
+
+def run_job(request: JobRequest, progress: Callable[[int, int], None], cancelled: threading.Event):
+    if request.kind == 'cashflow':
+        from .cashflow import cashflow_plot
+        from .charts import read_scenario
+
+        return cashflow_plot(*read_scenario(request.cashflow_id))
+
+    if request.kind == 'solve':
+        from .solver import solve
+
+        return solve(request.cashflow_id, request.solve_for, request.mode, request.percentile, request.paths,
+                     request.seed, request.historical_start_year).model_dump()
+
+    run = make_run(request.cashflow_id, request.kind, request.paths, request.seed, request.x, request.y)
+    summary = None
+    for summary in summaries(run):
+        progress(summary.done, summary.total)
+        if cancelled.is_set() and summary.done < summary.total:
+            raise JobCancelled()
+    return summary.model_dump()
+
+
+@cache
+def job_queue() -> JobQueue:
+    # workers start with the first job
+    env = ENV()
+    return JobQueue(LocalJobStore(env.job_ttl), env.job_workers, env.job_queue_size)
+
+
+def find_job(job_id: str) -> Job:
+    store = job_queue().store
+    store.expire()
+    job = store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+
+@router.post('', status_code=202)
+def submit_job(request: JobRequest, response: Response) -> Job:
+    try:
+        job = job_queue().submit(request)
+    except QueueFull:
+        raise HTTPException(status_code=503, detail="Too many jobs queued, try again shortly",
+                            headers={'Retry-After': '5'})
+    response.headers['Location'] = f'/api/jobs/{job.job_id}'
+    return job
+
+
+@router.get('/{job_id}')
+def job_status(job_id: str) -> Job:
+    return find_job(job_id)
+
+
+@router.get('/{job_id}/result')
+def job_result(job_id: str) -> Response:
+    job = find_job(job_id)
+    if job.status != 'done':
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job.status}"
+                                                    + (f": {job.error}" if job.error else ''))
+    if job.request.kind == 'cashflow':
+        return HTMLResponse(job.result)
+    return JSONResponse(job.result)
+
+
+@router.delete('/{job_id}')
+def cancel_job(job_id: str) -> Job:
+    job = job_queue().cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
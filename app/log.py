@@ -0,0 +1,102 @@
+from __future__ import annotations as _annotations
+
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+from .env import ENV
+
+'''
+# Logging
+======================================================================
+Request threads only put records on a queue; a QueueListener thread
+formats them and writes to stdout. The message is filled in from its
+arguments as the record is queued, so later changes to them (a job, an
+ORM row) don't show up in the log; the layout, timestamp and traceback
+are left to the listener. DEBUG records can be sampled with
+LOG_DEBUG_SAMPLE, and a record sampled out is never formatted at all
+(log with logger.debug("x %s", value), not f-strings). LOG_FORMAT=json
+writes one JSON object per line.
+'''
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+listener: QueueListener | None = None
+
+
+class LazyQueueHandler(QueueHandler):
+    """QueueHandler that leaves all but the message to the listener thread."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the queue never leaves the process, so the record doesn't need to be made picklable,
+        # but its arguments are resolved now while they still hold the values that were logged
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class DebugSampler(logging.Filter):
+    """Passes every record above DEBUG and `rate` of the DEBUG ones."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record, TIME_FORMAT) + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'module': record.module,
+            'function': record.funcName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def init_logger():
+    global listener
+    env = ENV()
+    logger = logging.getLogger('cashflow')
+    if any(isinstance(h, LazyQueueHandler) for h in logger.handlers):
+        return
+
+    logger.setLevel(env.log_level)
+
+    handler = logging.StreamHandler(sys.stdout)
+    if env.log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            fmt='%(levelname)s:%(asctime)s.%(msecs)03d::%(name)s:%(module)s:%(funcName)s:%(message)s',
+            datefmt=TIME_FORMAT))
+
+    records = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(records)
+    queue_handler.addFilter(DebugSampler(env.log_debug_sample))
+    logger.addHandler(queue_handler)
+
+    listener = QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_logger)
+
+
+def stop_logger():
+    # flush anything still queued
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
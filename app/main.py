@@ -1,21 +1,32 @@
 from __future__ import annotations as _annotations
 
 from fastapi import APIRouter
-from fastui import AnyComponent, FastUI
+from fastui import FastUI
 from fastui import components as c
 from fastui.events import PageEvent
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import Response
 from fastui.events import GoToEvent
+from functools import cache
 
-from .shared import demo_page
-from .gilts import create_image
+from .shared import demo_page_response, dump_component
+from .gilts import chart_html, chart_version
 
 router = APIRouter()
 
 router.mount("/static", StaticFiles(directory="static"), name="static")
 
 @router.get('/', response_model=FastUI, response_model_exclude_none=True)
-def api_index() -> list[AnyComponent]:
+def api_index() -> Response:
+    # the yield curve the page loads from static/temp.html, drawn again only once the gilts change
+    chart_html(chart_version().etag)
+    #return demo_page(c.Markdown(text=markdown))
+    # return demo_page(c.Markdown(text=markdown), c.Div(components=[c.Text(text=html)]))
+    return demo_page_response(*index_components())
+
+
+@cache
+def index_components() -> list[bytes]:
     # language=markdown
     markdown = """\
 This site providers a demo of [FastUI](https://github.com/samuelcolvin/FastUI), the code for the demo
@@ -40,10 +51,7 @@ The following components are demonstrated:
 * `Pagination` — See the bottom of the [cities table](/table/cities)
 * `ModelForm` — See [forms](/forms/login)
 """
-    create_image()
-    #return demo_page(c.Markdown(text=markdown))
-    # return demo_page(c.Markdown(text=markdown), c.Div(components=[c.Text(text=html)]))
-    return demo_page(
+    components = [
         c.Div(
             components=[
                 c.Heading(text='Iframe', level=2),
@@ -80,7 +88,8 @@ The following components are demonstrated:
 
                          ],
                         )
-            )
+    ]
+    return [dump_component(component) for component in components]
 
 
 @router.get('/{path:path}', status_code=404)
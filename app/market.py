@@ -0,0 +1,108 @@
+from __future__ import annotations as _annotations
+
+import logging
+import threading
+from collections import OrderedDict
+from functools import cache
+from pathlib import Path
+
+import numpy as np
+
+from .closes import (MARKET_DATA, MAX_TICKERS, Closes, UnknownTicker, fetch_tickers, known_unknown,
+                     ticker_path)
+from .metrics import span
+
+logger = logging.getLogger('cashflow')
+
+
+class Stock:
+    def __init__(
+        self,
+        start = "1970",
+        end = "2023",
+        directory: Path = MARKET_DATA,
+        max_tickers: int = MAX_TICKERS
+    ):
+        # each ticker is fetched and memory-mapped the first time it's asked for, see closes.py
+        self.mapped: OrderedDict[str, Closes] = OrderedDict()
+        self.lock = threading.Lock()
+        self.directory = directory
+        self.max_tickers = max_tickers
+        self.start = str(start)
+        self.end = str(end)
+        self.ticker = ""
+
+    def __str__(self) -> str:
+        return f"{self.start} {self.end} {list(self.mapped)}"
+
+    def __repr__(self) -> str:
+        return f"{self.start} {self.end} {list(self.mapped)}"
+
+    def get_data(self, tickers=()):
+        # fetch the tickers that aren't on disk yet together rather than one by one on first use
+        missing = [t for t in tickers
+                   if not ticker_path(t, self.directory).exists() and not known_unknown(t, self.directory)]
+        if missing:
+            fetch_tickers(missing, self.start, self.end, self.directory)
+
+    def series(self, ticker: str) -> Closes:
+        with self.lock:
+            closes = self.mapped.get(ticker)
+            if closes is not None and not closes.stale():
+                self.mapped.move_to_end(ticker)
+                return closes
+
+        path = ticker_path(ticker, self.directory)
+        if not path.exists():
+            if known_unknown(ticker, self.directory) or \
+                    not fetch_tickers([ticker], self.start, self.end, self.directory).get(ticker, True):
+                raise UnknownTicker(f"No returns data for {ticker}")
+
+        closes = Closes(path)
+        logger.debug("Mapped returns data %s", closes)
+        with self.lock:
+            self.mapped[ticker] = closes
+            self.mapped.move_to_end(ticker)
+            while len(self.mapped) > self.max_tickers:
+                # the mapping goes once nothing still holds one of its arrays
+                evicted, _ = self.mapped.popitem(last=False)
+                logger.debug("Unmapped returns data for %s", evicted)
+        return closes
+
+    def yearly_growth(self, ticker: str) -> tuple[np.ndarray, np.ndarray]:
+        """Every year in the ticker's history and its growth multiplier, NaN for the first."""
+        closes = self.series(ticker)
+        dates = closes.dates
+        close = closes.column(ticker)
+
+        # the last trading day of each year
+        year = dates.astype('datetime64[Y]').astype(int) + 1970
+        last_day = np.flatnonzero(np.append(year[1:] != year[:-1], True))
+        year, year_end = year[last_day], close[last_day]
+
+        # a missing year end close carries the previous one forward, as pandas ffill() did
+        known = np.where(np.isnan(year_end), 0, np.arange(len(year_end)))
+        year_end = year_end[np.maximum.accumulate(known)]
+
+        return year, np.append(np.nan, year_end[1:] / year_end[:-1] - 1) + 1
+
+    @span('market_returns')
+    def get_yearly_returns(self,start,years,ticker):
+
+        logger.debug("Returning data for %s,%s,%s", ticker, start, years)
+        self.ticker = ticker
+
+        year, growth = self.yearly_growth(ticker)
+        return growth[(year >= int(start)) & (year < int(start)+int(years))]
+
+
+    def get_ticker(self):
+        return self.ticker
+
+
+@cache
+def stock_returns() -> Stock:
+    # one per process, made when returns are first needed
+    stock = Stock()
+    logger.debug("%s", stock)
+    return stock
@@ -0,0 +1,249 @@
+from __future__ import annotations as _annotations
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+from fastapi import APIRouter
+from fastapi.responses import Response
+from sqlalchemy import event
+
+from .env import ENV
+
+logger = logging.getLogger('cashflow')
+router = APIRouter()
+env = ENV()
+
+'''
+# Metrics
+======================================================================
+Request and stage timings kept in process as Prometheus histograms and
+served in the text exposition format at /metrics, with lru_cache hit rates
+and connection pool usage read at scrape time. Recording is a lock and a
+bisect per observation, nothing is formatted until something scrapes.
+
+    with span('fig_to_html'):
+        ...
+
+    @span('drawdown')
+    def drawdown(...):
+
+Stages timed during a request are also returned in its Server-Timing header.
+Every query is counted against its request; slow statements are logged
+with their parameters, a statement repeated N_PLUS_ONE_THRESHOLD times in
+one request is logged as a likely N+1, and with DEBUG=1 the request's
+query count and DB time come back as X-DB-Queries / X-DB-Time-ms headers.
+'''
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...], buckets: tuple[float, ...] = BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series: dict[tuple[str, ...], list] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, seconds: float, *label_values: str):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                # per-bucket counts, then sum and count
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect_left(self.buckets, seconds)] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            snapshot = [(values, list(counts), total, count) for values, (counts, total, count) in self.series.items()]
+        for values, counts, total, count in sorted(snapshot):
+            labels = ','.join(f'{k}="{escape(v)}"' for k, v in zip(self.labels, values))
+            prefix = labels + ',' if labels else ''
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {count}')
+        return lines
+
+
+def escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUESTS = Histogram('cashflow_request_seconds', 'HTTP request duration by route.', ('method', 'route', 'status'))
+STAGES = Histogram('cashflow_stage_seconds', 'Time spent in each stage of a request.', ('stage',))
+REQUEST_QUERIES = Histogram('cashflow_request_queries', 'SQL statements executed per request.', ('route',),
+                            QUERY_BUCKETS)
+
+
+@dataclass
+class RequestStats:
+    path: str
+    stages: dict[str, float] = field(default_factory=dict)
+    queries: int = 0
+    db_seconds: float = 0.0
+    statements: Counter = field(default_factory=Counter)
+
+
+# the current request's timings, for its headers
+request_stats: ContextVar[RequestStats | None] = ContextVar('request_stats', default=None)
+
+# lru_cache functions, SQLAlchemy engines and single flights (singleflight.py) reported at scrape time
+CACHES: dict[str, object] = {}
+ENGINES: dict[str, object] = {}
+FLIGHTS: dict[str, object] = {}
+
+
+def record(stage: str, seconds: float):
+    STAGES.observe(seconds, stage)
+    stats = request_stats.get()
+    if stats is not None:
+        stats.stages[stage] = stats.stages.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def span(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def track_cache(fn, name: str | None = None):
+    CACHES[name or f'{fn.__module__}.{fn.__qualname__}'] = fn
+    return fn
+
+
+def track_engine(engine, name: str | None = None):
+    """Report the engine's pool at scrape time and time its queries as the db stage."""
+    ENGINES[name or engine.url.render_as_string(hide_password=True)] = engine
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def query_start(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def query_end(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['query_start'].pop()
+        record('db', seconds)
+        query_done(statement, parameters, seconds)
+
+    return engine
+
+
+def query_done(statement: str, parameters, seconds: float):
+    if seconds * 1000 >= env.slow_query_ms:
+        logger.warning("Slow query %.1fms: %s %.500r", seconds * 1000, statement, parameters)
+
+    stats = request_stats.get()
+    if stats is None:
+        return
+    stats.queries += 1
+    stats.db_seconds += seconds
+    stats.statements[statement] += 1
+    if stats.statements[statement] == env.n_plus_one:
+        logger.warning("Possible N+1 in %s: the same statement ran %d times: %.200s",
+                       stats.path, env.n_plus_one, statement)
+
+
+class MetricsMiddleware:
+    """Times every HTTP request by route template and adds its Server-Timing header."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        stats = RequestStats(path=scope['path'])
+        token = request_stats.set(stats)
+        status = '500'
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = str(message['status'])
+                timings = [f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in stats.stages.items()]
+                timings.append(f'app;dur={(time.perf_counter() - start) * 1000:.1f}')
+                headers = [(b'server-timing', ', '.join(timings).encode())]
+                if env.debug:
+                    headers += [(b'x-db-queries', str(stats.queries).encode()),
+                                (b'x-db-time-ms', f'{stats.db_seconds * 1000:.1f}'.encode())]
+                message['headers'] = [*message.get('headers', []), *headers]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_stats.reset(token)
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            REQUESTS.observe(time.perf_counter() - start, scope['method'], route, status)
+            REQUEST_QUERIES.observe(stats.queries, route)
+
+
+def cache_lines() -> list[str]:
+    lines = []
+    for metric, kind, help in (('cashflow_cache_hits_total', 'counter', 'lru_cache hits.'),
+                               ('cashflow_cache_misses_total', 'counter', 'lru_cache misses.'),
+                               ('cashflow_cache_hit_ratio', 'gauge', 'lru_cache hits over lookups.'),
+                               ('cashflow_cache_entries', 'gauge', 'lru_cache entries held.')):
+        lines += [f'# HELP {metric} {help}', f'# TYPE {metric} {kind}']
+        for name, fn in sorted(CACHES.items()):
+            info = fn.cache_info()
+            value = {'cashflow_cache_hits_total': info.hits,
+                     'cashflow_cache_misses_total': info.misses,
+                     'cashflow_cache_hit_ratio': round(info.hits / max(info.hits + info.misses, 1), 4),
+                     'cashflow_cache_entries': info.currsize}[metric]
+            lines.append(f'{metric}{{cache="{escape(name)}"}} {value}')
+    return lines
+
+
+def pool_lines() -> list[str]:
+    lines = []
+    for metric, method, help in (('cashflow_db_pool_size', 'size', 'Connections the pool keeps open.'),
+                                 ('cashflow_db_pool_checked_out', 'checkedout', 'Connections in use.'),
+                                 ('cashflow_db_pool_overflow', 'overflow', 'Connections opened beyond the pool size.')):
+        lines += [f'# HELP {metric} {help}', f'# TYPE {metric} gauge']
+        for name, engine in sorted(ENGINES.items()):
+            # only QueuePool-style pools report usage
+            if hasattr(engine.pool, method):
+                lines.append(f'{metric}{{engine="{escape(name)}"}} {getattr(engine.pool, method)()}')
+    return lines
+
+
+def flight_lines() -> list[str]:
+    lines = []
+    for metric, attribute, help in (('cashflow_singleflight_calls_total', 'started', 'Calls that did the work.'),
+                                    ('cashflow_singleflight_coalesced_total', 'coalesced',
+                                     'Calls that shared the result of one already in flight.')):
+        lines += [f'# HELP {metric} {help}', f'# TYPE {metric} counter']
+        for name, flight in sorted(FLIGHTS.items()):
+            lines.append(f'{metric}{{flight="{escape(name)}"}} {getattr(flight, attribute)}')
+    return lines
+
+
+def exposition() -> str:
+    return '\n'.join(REQUESTS.render() + STAGES.render() + REQUEST_QUERIES.render()
+                     + cache_lines() + pool_lines() + flight_lines()) + '\n'
+
+
+@router.get('/metrics', include_in_schema=False)
+def metrics() -> Response:
+    return Response(exposition(), media_type='text/plain; version=0.0.4')
@@ -0,0 +1,65 @@
+from __future__ import annotations as _annotations
+
+import io
+import locale
+import re
+import threading
+from functools import cache, wraps
+from typing import Literal
+
+'''
+matplotlib and mpld3 take most of the app's import time, so the chart
+modules get them from here on first use instead of importing them at the
+top of the module.
+
+pyplot keeps one current figure per process, so anything that draws with
+it runs under pyplot_lock (@one_figure_at_a_time); charts are rendered
+from the threadpool and job workers as well as the event loop.
+
+The same charts can be drawn as a static PNG or SVG (figure_bytes) for
+embeds, emails and reports that don't need mpld3's JavaScript.
+'''
+
+ImageFormat = Literal['png', 'svg']
+MEDIA_TYPES: dict[str, str] = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+pyplot_lock = threading.RLock()
+
+
+@cache
+def charting():
+    """(matplotlib.pyplot, mpld3) on the Agg backend."""
+    locale.setlocale(locale.LC_ALL, '')
+    import matplotlib
+    matplotlib.use("AGG")
+    import matplotlib.pyplot as plt
+    import mpld3
+    return plt, mpld3
+
+
+def one_figure_at_a_time(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with pyplot_lock:
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def figure_bytes(fig, fmt: ImageFormat) -> bytes:
+    """fig as an optimised PNG or a minified SVG, closing it."""
+    plt, _ = charting()
+    buffer = io.BytesIO()
+    try:
+        if fmt == 'png':
+            fig.savefig(buffer, format='png', dpi=100, pil_kwargs={'optimize': True})
+        else:
+            # text as <text> rather than glyph paths, and the same bytes for the same chart
+            with plt.rc_context({'svg.fonttype': 'none', 'svg.hashsalt': 'cashflow'}):
+                fig.savefig(buffer, format='svg', metadata={'Date': None})
+    finally:
+        plt.close(fig)
+
+    image = buffer.getvalue()
+    if fmt == 'svg':
+        image = re.sub(rb'>\s+<', b'><', re.sub(rb'<!--.*?-->', b'', image, flags=re.S))
+    return image
@@ -0,0 +1,252 @@
+from __future__ import annotations as _annotations
+
+import logging
+import os
+import threading
+from functools import lru_cache
+
+import numpy as np
+from fastapi import APIRouter, HTTPException, Query
+from pydantic import BaseModel
+from sqlalchemy.orm import Session
+
+from .closes import UnknownTicker, file_identity, ticker_path
+from .env import database
+from .gilts import Gilt
+from .market import stock_returns
+from .metrics import span, track_cache
+
+logger = logging.getLogger('cashflow')
+router = APIRouter()
+
+'''
+# Portfolios
+======================================================================
+A cashflow's ticker can name a portfolio instead of a single index, as
+ticker:weight pairs with GILTS for a bond sleeve:
+
+    ^GSPC:60,^FTSE:20,GILTS:20
+
+Weights are normalised to sum to one and the portfolio is rebalanced every
+year, so its growth is the weights times a (tickers, years) matrix of
+yearly growth. The bond sleeve buys the current conventional gilt curve
+and holds it, so year t earns the forward rate between t - 1 and t.
+
+Each ticker set's full history is read from the market data once
+(equity_history) and each (portfolio, window) blended once
+(portfolio_returns); engine.return_path and engine.sampled_paths use these
+for anything that isn't a plain ticker. check_market() clears these and
+everything downstream of them once a ticker's closes file is replaced.
+'''
+
+BONDS = 'GILTS'
+# bumped by clear_bond_caches(), for anything keyed on the curve it was drawn from
+bond_generation = 0
+
+
+class InvalidPortfolio(UnknownTicker):
+    pass
+
+
+class Portfolio(BaseModel, frozen=True):
+    equities: tuple[tuple[str, float], ...]     # (ticker, weight)
+    bonds: float = 0.0
+
+    @classmethod
+    def parse(cls, spec: str) -> Portfolio:
+        weights = {}
+        for part in spec.split(','):
+            ticker, _, weight = part.strip().rpartition(':') if ':' in part else (part.strip(), '', '1')
+            try:
+                weight = float(weight)
+            except ValueError:
+                raise InvalidPortfolio(f"Portfolio {spec!r} should be ticker:weight pairs, e.g. ^GSPC:60,GILTS:40")
+            if not ticker or not weight > 0:
+                raise InvalidPortfolio(f"Portfolio {spec!r} needs a ticker and a positive weight in each part")
+            weights[ticker] = weights.get(ticker, 0.0) + weight
+
+        total = sum(weights.values())
+        bonds = weights.pop(BONDS, 0.0)
+        return cls(equities=tuple((ticker, weight / total) for ticker, weight in sorted(weights.items())),
+                   bonds=bonds / total)
+
+    @property
+    def tickers(self) -> tuple[str, ...]:
+        return tuple(ticker for ticker, _ in self.equities)
+
+    @property
+    def weights(self) -> np.ndarray:
+        return np.array([weight for _, weight in self.equities])
+
+    @property
+    def single(self) -> bool:
+        # a plain ticker, which the engine reads directly
+        return len(self.equities) == 1 and not self.bonds
+
+    def __str__(self) -> str:
+        parts = [f'{ticker}:{weight:.0%}' for ticker, weight in self.equities]
+        return ','.join(parts + ([f'{BONDS}:{self.bonds:.0%}'] if self.bonds else []))
+
+
+@track_cache
+@lru_cache(maxsize=64)
+def equity_history(tickers: tuple[str, ...]) -> tuple[np.ndarray, np.ndarray]:
+    """Years and a (tickers, years) matrix of every ticker's yearly growth, NaN where it has none."""
+    stock = stock_returns()
+    stock.get_data(tickers)
+    years = np.arange(int(stock.start), int(stock.end))
+    matrix = np.full((len(tickers), len(years)), np.nan)
+    for n, ticker in enumerate(tickers):
+        year, growth = stock.yearly_growth(ticker)
+        held = (year >= years[0]) & (year <= years[-1])
+        matrix[n, year[held] - years[0]] = growth[held]
+    matrix.flags.writeable = False
+    return years, matrix
+
+
+@lru_cache(maxsize=1)
+def bond_curve() -> tuple[np.ndarray, np.ndarray]:
+    """Years to redemption and yield (%) of the conventional gilts, shortest first."""
+    with Session(database().get_engine()) as session:
+        rows = (
+            session.query(Gilt)
+            .with_entities(Gilt.years_to_redemption, Gilt.calculated_yield)
+            .filter(Gilt.instrument_type.contains("%Conventional%"))
+            .order_by(Gilt.years_to_redemption)
+            .all()
+        )
+    curve = np.array([(float(r.years_to_redemption), float(r.calculated_yield)) for r in rows
+                      if r.years_to_redemption is not None and r.calculated_yield is not None]).reshape(-1, 2)
+    if not len(curve):
+        raise UnknownTicker(f"No gilt yields for the {BONDS} sleeve")
+    logger.info(f"Read a {len(curve)} gilt yield curve for the bond sleeve")
+    return curve[:, 0], curve[:, 1]
+
+
+def bond_growth(years: int) -> np.ndarray:
+    # held to maturity, a pound grows to (1 + y(t)) ** t by year t, flat beyond the ends of the curve
+    maturity, yields = bond_curve()
+    t = np.arange(1, years + 1)
+    value = (1 + np.interp(t, maturity, yields) / 100) ** t
+    return value / np.append(1.0, value[:-1])
+
+
+@track_cache
+@lru_cache(maxsize=256)
+@span('portfolio_returns')
+def portfolio_returns(portfolio: Portfolio, historical_start_year: int, years: int) -> np.ndarray:
+    """Blended yearly growth over the window, shorter if the history runs out first."""
+    if portfolio.equities:
+        history, matrix = equity_history(portfolio.tickers)
+        window = (history >= historical_start_year) & (history < historical_start_year + years)
+        growth = portfolio.weights @ matrix[:, window]
+    else:
+        growth = np.zeros(years)
+    if portfolio.bonds:
+        growth = growth + portfolio.bonds * bond_growth(len(growth))
+    growth.flags.writeable = False
+    return growth
+
+
+def sampled_portfolio_paths(portfolio: Portfolio, years: int, count: int, seed: int = 0) -> np.ndarray:
+    """
+    (count, years) paths bootstrapped from whole historical years, so the
+    tickers move together as they did; the bond sleeve follows the curve.
+    """
+    growth = np.zeros((count, years))
+    if portfolio.equities:
+        _, matrix = equity_history(portfolio.tickers)
+        complete = np.flatnonzero(~np.isnan(matrix).any(axis=0))
+        if not len(complete):
+            raise ValueError(f"No years with history for every ticker in {portfolio}")
+        rng = np.random.default_rng(seed)
+        growth = np.tensordot(portfolio.weights, matrix[:, rng.choice(complete, size=(count, years))], axes=1)
+    if portfolio.bonds:
+        growth = growth + portfolio.bonds * bond_growth(years)
+    growth.flags.writeable = False
+    return growth
+
+
+def clear_market_caches():
+    """Everything drawn from the closes files or the bond curve, in this worker."""
+    from .charts import cashflow_image
+    from .engine import project, return_path
+    from .sensitivity import evaluate_grid, sensitivity_html
+
+    for cache in (equity_history, portfolio_returns, return_path, project, evaluate_grid, sensitivity_html,
+                  cashflow_image):
+        cache.cache_clear()
+
+
+def clear_bond_caches():
+    # after the gilts change; only this worker's caches, the others keep their curve until restarted
+    global bond_generation
+
+    bond_generation += 1
+    bond_curve.cache_clear()
+    clear_market_caches()
+
+
+def closes_identity(ticker: str) -> tuple[int, int, int] | None:
+    try:
+        return file_identity(os.stat(ticker_path(ticker, stock_returns().directory)))
+    except FileNotFoundError:
+        return None
+
+
+# the closes file each ticker was read from when last checked, see check_market()
+market_seen: dict[str, tuple[int, int, int] | None] = {}
+market_lock = threading.Lock()
+
+
+def check_market(spec: str):
+    """
+    Clear the market caches if a closes file the ticker or portfolio reads has
+    been replaced since it was last checked, by a refresh in any worker.
+    Call before anything cached on the returns.
+    """
+    try:
+        identities = {ticker: closes_identity(ticker) for ticker in Portfolio.parse(spec).tickers}
+    except UnknownTicker:
+        return      # reported by whatever reads the returns
+    with market_lock:
+        changed = [t for t, identity in identities.items() if market_seen.get(t, identity) != identity]
+        market_seen.update(identities)
+        if changed:
+            logger.info(f"Market data for {', '.join(changed)} changed, clearing the market caches")
+            clear_market_caches()
+
+
+def market_version(spec: str) -> str:
+    """Which market data a ticker or portfolio's returns come from: its tickers' closes files and the bond curve."""
+    portfolio = Portfolio.parse(spec)
+    return repr(([closes_identity(ticker) for ticker in portfolio.tickers],
+                 bond_generation if portfolio.bonds else None))
+
+
+class PortfolioReturns(BaseModel):
+    portfolio: str
+    historical_start_year: int
+    years: list[int]
+    growth: list[float | None]
+    annualised: float | None
+
+
+@router.get('')
+def portfolio_view(spec: str = Query(description='ticker:weight,... e.g. ^GSPC:60,GILTS:40'),
+                   historical_start_year: int = 1990, years: int = 30) -> PortfolioReturns:
+    try:
+        portfolio = Portfolio.parse(spec)
+        check_market(spec)
+        growth = portfolio_returns(portfolio, historical_start_year, years)
+    except UnknownTicker as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    known = growth[~np.isnan(growth)]
+    return PortfolioReturns(
+        portfolio=str(portfolio),
+        historical_start_year=historical_start_year,
+        years=list(range(historical_start_year, historical_start_year + len(growth))),
+        growth=[None if np.isnan(g) else round(float(g), 6) for g in growth],
+        annualised=round(float(np.prod(known) ** (1 / len(known)) - 1), 6) if len(known) else None,
+    )
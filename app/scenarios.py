@@ -0,0 +1,140 @@
+from __future__ import annotations as _annotations
+
+import logging
+from datetime import date
+
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel, ValidationError, model_validator
+
+from .charts import read_scenario
+from .closes import UnknownTicker
+from .dao import ScenarioNotFound, update_scenario
+from .engine import build_scenario, simulate
+from .forms import IncomeModel, ParametersModel, PotModel
+
+logger = logging.getLogger('cashflow')
+router = APIRouter()
+
+'''
+# Scenario edits
+======================================================================
+One request for any mix of changes to a cashflow's pots, incomes and
+parameters, answered with the recomputed outcome:
+
+    PATCH /api/scenarios/1
+    {"pots": [{"pot_id": 2, "amount": 250000}], "parameters": {"retirement_age": 62}}
+
+Only the fields given change. The patched scenario is run before anything
+is written, so an unknown ticker or a pot from another cashflow changes
+nothing; then every change is written in one transaction. An edit is one
+round trip instead of a form post per section and a chart reload.
+'''
+
+
+class Patch(BaseModel):
+    @model_validator(mode='after')
+    def no_nulls(self):
+        # leaving a field out keeps it, null would blank a column the scenario can't do without
+        nulls = sorted(name for name in self.model_fields_set if getattr(self, name) is None)
+        if nulls:
+            raise ValueError(f"{', '.join(nulls)} can't be null; leave a field out to keep its value")
+        return self
+
+
+class PotPatch(Patch):
+    pot_id: int
+    name: str | None = None
+    type: str | None = None
+    amount: int | None = None
+
+
+class IncomePatch(Patch):
+    income_id: int
+    name: str | None = None
+    type: str | None = None
+    amount: int | None = None
+    inflation_yearly: bool | None = None
+    repeating_yearly: bool | None = None
+    start_date: date | None = None
+
+
+class ParametersPatch(Patch):
+    target_income: int | None = None
+    inflation: int | None = None
+    growth: int | None = None
+    age: int | None = None
+    retirement_age: int | None = None
+    years: int | None = None
+    ticker: str | None = None
+    historical_start_year: int | None = None
+    charges: float | None = None
+
+
+class ScenarioPatch(BaseModel):
+    pots: list[PotPatch] = []
+    incomes: list[IncomePatch] = []
+    parameters: ParametersPatch | None = None
+
+
+class ScenarioOutcome(BaseModel):
+    cashflow_id: int
+    pots: list[PotModel]
+    incomes: list[IncomeModel]
+    parameters: ParametersModel
+    success: bool
+    final_balance: float
+    shortfall: float
+
+
+def patched(models: list, changes: list, key: str, cashflow_id: int) -> list:
+    by_id = {getattr(model, key): n for n, model in enumerate(models)}
+    models = list(models)
+    for change in changes:
+        n = by_id.get(getattr(change, key))
+        if n is None:
+            raise HTTPException(status_code=404, detail=f"Cashflow {cashflow_id} has no {key[:-3]} {getattr(change, key)}")
+        models[n] = validated(models[n], change)
+    return models
+
+
+def validated(model: BaseModel, change: Patch) -> BaseModel:
+    # validated as a whole, so a bad value is a 422 before anything is written
+    try:
+        return type(model).model_validate({**model.model_dump(), **change.model_dump(exclude_unset=True)})
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+
+
+@router.patch('/{cashflow_id:int}')
+def patch_scenario(cashflow_id: int, patch: ScenarioPatch) -> ScenarioOutcome:
+    pots, incomes, params = read_scenario(cashflow_id)
+    pots = patched(pots, patch.pots, 'pot_id', cashflow_id)
+    incomes = patched(incomes, patch.incomes, 'income_id', cashflow_id)
+    if patch.parameters:
+        params = validated(params, patch.parameters)
+
+    try:
+        outcome = simulate([build_scenario(pots, incomes, params)])
+    except UnknownTicker as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    try:
+        update_scenario(cashflow_id,
+                        [pot.model_dump(exclude_unset=True) for pot in patch.pots],
+                        [income.model_dump(exclude_unset=True) for income in patch.incomes],
+                        patch.parameters.model_dump(exclude_unset=True) if patch.parameters else {})
+    except ScenarioNotFound as e:
+        # removed since it was read
+        raise HTTPException(status_code=404, detail=str(e))
+    logger.info(f"Saved {len(patch.pots)} pots, {len(patch.incomes)} incomes"
+                f"{' and parameters' if patch.parameters else ''} for cashflow {cashflow_id}")
+
+    return ScenarioOutcome(
+        cashflow_id=cashflow_id,
+        pots=pots,
+        incomes=incomes,
+        parameters=params,
+        success=bool(outcome.success[0]),
+        final_balance=round(float(outcome.final_balance[0]), 2),
+        shortfall=round(float(outcome.shortfall[0]), 2),
+    )
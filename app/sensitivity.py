@@ -0,0 +1,171 @@
+from __future__ import annotations as _annotations
+
+import dataclasses
+import logging
+import time
+from functools import lru_cache
+from typing import Literal
+
+import numpy as np
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import HTMLResponse
+from pydantic import BaseModel
+
+from .charts import read_scenario
+from .closes import UnknownTicker
+from .engine import Scenario, build_scenario, simulate
+from .metrics import track_cache
+from .plotting import charting, one_figure_at_a_time
+
+logger = logging.getLogger('cashflow')
+router = APIRouter()
+
+'''
+# Sensitivity grid
+======================================================================
+Two or three ParametersModel fields are swept over a grid and every cell
+is run through one batched drawdown (engine.simulate). Axes are given as
+field:start:stop:steps, e.g.
+
+    /charts/sensitivity/1?x=target_income:30000:80000:26&y=retirement_age:55:70:16
+
+A third axis (z) draws one heatmap per value.
+'''
+
+# fields that can vary without changing the pots or the number of years
+GRID_FIELDS = ('target_income', 'retirement_age', 'growth', 'charges', 'inflation', 'historical_start_year')
+INTEGER_FIELDS = ('retirement_age', 'historical_start_year')
+MAX_CELLS = 20000
+
+Metric = Literal['success', 'final_balance']
+
+
+class Axis(BaseModel, frozen=True):
+    field: str
+    values: tuple[float, ...]
+
+    @classmethod
+    def parse(cls, spec: str) -> Axis:
+        try:
+            field, start, stop, steps = spec.split(':')
+            start, stop, steps = float(start), float(stop), int(steps)
+        except ValueError:
+            raise HTTPException(status_code=422, detail=f"Axis {spec!r} should be field:start:stop:steps")
+        if field not in GRID_FIELDS:
+            raise HTTPException(status_code=422, detail=f"Axis field {field!r} should be one of {', '.join(GRID_FIELDS)}")
+        if not 1 <= steps <= 1000:
+            raise HTTPException(status_code=422, detail=f"Axis {field} needs between 1 and 1000 steps")
+
+        values = np.linspace(start, stop, steps)
+        if field in INTEGER_FIELDS:
+            values = np.unique(np.round(values))
+        return cls(field=field, values=tuple(float(v) for v in values))
+
+    def label(self, value: float) -> str:
+        return f"{value:.0f}" if self.field in INTEGER_FIELDS or abs(value) >= 100 else f"{value:g}"
+
+
+@dataclasses.dataclass(frozen=True)
+class Grid:
+    axes: tuple[Axis, ...]
+    success: np.ndarray          # (z, y, x) or (y, x)
+    final_balance: np.ndarray
+    milliseconds: float
+
+
+def cell_scenario(bases: dict[int, Scenario], axes: tuple[Axis, ...], cell: tuple[float, ...]) -> Scenario:
+    overrides = {axis.field: value for axis, value in zip(axes, cell)}
+    base = bases[int(overrides.pop('retirement_age', -1))]
+    for field in INTEGER_FIELDS:
+        if field in overrides:
+            overrides[field] = int(overrides[field])
+    return dataclasses.replace(base, **overrides)
+
+
+@track_cache
+@lru_cache(maxsize=64)
+def evaluate_grid(bases: tuple[tuple[int, Scenario], ...], axes: tuple[Axis, ...]) -> Grid:
+    """
+    Every cell of the grid in one simulate() call. bases holds the scenario
+    for each retirement age on the grid, as that moves the income start years.
+    """
+    start = time.perf_counter()
+    lookup = dict(bases)
+    cells = np.array(np.meshgrid(*(axis.values for axis in axes), indexing='ij')).reshape(len(axes), -1).T
+    outcome = simulate([cell_scenario(lookup, axes, tuple(cell)) for cell in cells])
+
+    # meshgrid is (x, y[, z]); the heatmaps want rows of y for each z
+    shape = tuple(len(axis.values) for axis in axes)
+    order = tuple(reversed(range(len(axes))))
+    grid = Grid(
+        axes=axes,
+        success=outcome.success.reshape(shape).transpose(order),
+        final_balance=outcome.final_balance.reshape(shape).transpose(order),
+        milliseconds=round((time.perf_counter() - start) * 1000, 1),
+    )
+    logger.info(f"Evaluated {len(cells)} cell sensitivity grid in {grid.milliseconds}ms")
+    return grid
+
+
+@one_figure_at_a_time
+def heatmap_html(grid: Grid, metric: Metric) -> str:
+    values = getattr(grid, metric).astype(float)
+    if len(grid.axes) == 2:
+        values = values[np.newaxis]
+    x, y = grid.axes[0], grid.axes[1]
+    z = grid.axes[2] if len(grid.axes) == 3 else None
+
+    plt, mpld3 = charting()
+    plt.close()
+    fig, axs = plt.subplots(1, len(values), figsize=(min(4 * len(values), 24), 4.5), squeeze=False,
+                            layout='compressed')
+    vmin, vmax = (0, 1) if metric == 'success' else (values.min(), values.max())
+
+    for n, ax in enumerate(axs[0]):
+        ax.imshow(values[n], origin='lower', aspect='auto', cmap='RdYlGn', vmin=vmin, vmax=vmax)
+        xticks = np.linspace(0, len(x.values) - 1, min(len(x.values), 8)).round().astype(int)
+        yticks = np.linspace(0, len(y.values) - 1, min(len(y.values), 8)).round().astype(int)
+        ax.set_xticks(xticks, [x.label(x.values[i]) for i in xticks])
+        ax.set_yticks(yticks, [y.label(y.values[i]) for i in yticks])
+        ax.set_xlabel(x.field)
+        ax.set_ylabel(y.field)
+        ax.set_title(f"{'Success' if metric == 'success' else 'Final balance £'}"
+                     f"{f' ({z.field} {z.label(z.values[n])})' if z else ''}")
+        ax.grid(False)
+
+    return mpld3.fig_to_html(fig)
+
+
+@track_cache
+@lru_cache(maxsize=64)
+def sensitivity_html(bases: tuple[tuple[int, Scenario], ...], axes: tuple[Axis, ...], metric: Metric) -> str:
+    return heatmap_html(evaluate_grid(bases, axes), metric)
+
+
+@router.get('/sensitivity/{cashflow_id:int}')
+def charts_sensitivity(cashflow_id: int,
+                       x: str = Query(description='field:start:stop:steps'),
+                       y: str = Query(description='field:start:stop:steps'),
+                       z: str | None = Query(default=None, description='field:start:stop:steps'),
+                       metric: Metric = 'success') -> HTMLResponse:
+    # a plain def, so the reads, the grid and waiting for pyplot_lock happen on the threadpool
+    axes = tuple(Axis.parse(spec) for spec in (x, y, z) if spec)
+    if len({axis.field for axis in axes}) != len(axes):
+        raise HTTPException(status_code=422, detail="Each axis needs a different field")
+    cells = int(np.prod([len(axis.values) for axis in axes]))
+    if cells > MAX_CELLS:
+        raise HTTPException(status_code=422, detail=f"Grid has {cells} cells, the limit is {MAX_CELLS}")
+
+    pots, incomes, params = read_scenario(cashflow_id)
+    if not pots:
+        raise HTTPException(status_code=422, detail=f"Cashflow {cashflow_id} has no pots")
+
+    ages = next((axis.values for axis in axes if axis.field == 'retirement_age'), (-1,))
+    bases = tuple((int(age), build_scenario(pots, incomes, params if age < 0 else
+                                            params.model_copy(update={'retirement_age': int(age)})))
+                  for age in ages)
+
+    try:
+        return HTMLResponse(sensitivity_html(bases, axes, metric))
+    except UnknownTicker as e:
+        raise HTTPException(status_code=422, detail=str(e))
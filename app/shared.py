@@ -1,8 +1,20 @@
 from __future__ import annotations as _annotations
 
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from functools import lru_cache
+
+from fastapi import Request
+from fastapi.responses import Response
 from fastui import AnyComponent
 from fastui import components as c
 from fastui.events import GoToEvent
+from pydantic import BaseModel, TypeAdapter
+
+from .metrics import track_cache
+
+# stands in for the per-request components when a page frame is serialised
+PLACEHOLDER = c.Text(text='__page_components__')
 
 
 def demo_page(*components: AnyComponent, title: str | None = None) -> list[AnyComponent]:
@@ -37,3 +49,80 @@ def demo_page(*components: AnyComponent, title: str | None = None) -> list[AnyCo
             ],
         ),
     ]
+
+
+def dump_component(component: AnyComponent) -> bytes:
+    # same shape FastAPI produces for response_model=FastUI, response_model_exclude_none=True
+    return component.model_dump_json(by_alias=True, exclude_none=True).encode()
+
+
+@track_cache
+@lru_cache(maxsize=512)
+def page_frame(title: str | None = None) -> tuple[bytes, bytes]:
+    """
+    demo_page() serialised once per title and split around the page body,
+    so a request only has to serialise its own components.
+    """
+    frame = b'[' + b','.join(dump_component(part) for part in demo_page(PLACEHOLDER, title=title)) + b']'
+    head, tail = frame.split(dump_component(PLACEHOLDER))
+    return head, tail
+
+
+def demo_page_response(*components: AnyComponent | bytes, title: str | None = None) -> Response:
+    """
+    Equivalent of returning demo_page(*components, title=title) from a
+    FastUI route. Components may be given pre-serialised (see dump_component)
+    to reuse cached static parts.
+    """
+    head, tail = page_frame(title)
+    body = b','.join(part if isinstance(part, bytes) else dump_component(part) for part in components)
+    if not body:
+        head = head.rstrip(b',')
+    return Response(head + body + tail, media_type='application/json')
+
+
+@track_cache
+@lru_cache
+def rows_adapter(data_model: type[BaseModel]) -> TypeAdapter:
+    return TypeAdapter(list[data_model])
+
+
+def table_json(data_model: type[BaseModel], data: list, **kwargs) -> bytes:
+    """
+    Serialised c.Table(data_model=data_model, data=data, **kwargs).
+
+    The rows skip the Table's own validation and SerializeAsAny handling and go
+    straight through a list[data_model] serializer. Rows may be model instances
+    or anything data_model can validate from attributes (e.g. SQLAlchemy rows).
+    """
+    adapter = rows_adapter(data_model)
+    if data and not isinstance(data[0], data_model):
+        data = adapter.validate_python(data, from_attributes=True)
+
+    head, tail = dump_component(c.Table(data_model=data_model, data=[], **kwargs)).split(b'"data":[]', 1)
+    return head + b'"data":' + adapter.dump_json(data, by_alias=True, exclude_none=True) + tail
+
+
+def validators(etag: str, last_modified: datetime | None = None) -> dict[str, str]:
+    """ETag and Last-Modified headers, asking browsers to revalidate before every reuse."""
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+    if last_modified is not None:
+        headers['Last-Modified'] = format_datetime(last_modified.astimezone(timezone.utc), usegmt=True)
+    return headers
+
+
+def not_modified(request: Request, headers: dict[str, str]) -> bool:
+    """Whether the request's If-None-Match / If-Modified-Since already match headers from validators()."""
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        # If-None-Match wins over If-Modified-Since; compared weakly, as for GET
+        tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+        return '*' in tags or headers['ETag'] in tags
+
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is not None and 'Last-Modified' in headers:
+        try:
+            return parsedate_to_datetime(headers['Last-Modified']) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
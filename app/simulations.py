@@ -0,0 +1,245 @@
+from __future__ import annotations as _annotations
+
+import dataclasses
+import logging
+import time
+from functools import cache
+from typing import Callable, Iterator, Literal
+
+import numpy as np
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
+from fastui import FastUI
+from fastui import components as c
+from fastui.events import GoToEvent
+from pydantic import BaseModel
+
+from .charts import read_scenario
+from .closes import UnknownTicker
+from .engine import Outcome, build_scenario, return_path, return_paths, sampled_paths, simulate
+from .portfolio import check_market
+from .sensitivity import MAX_CELLS, Axis, cell_scenario
+from .shared import demo_page_response, dump_component
+
+logger = logging.getLogger('cashflow')
+router = APIRouter()
+
+'''
+# Streamed simulations
+======================================================================
+Long runs are split into chunks and each chunk's outcomes are streamed to
+a FastUI ServerLoad(sse=True) as soon as they are in, so the page shows
+success rates and final balance percentiles over the first few hundred
+paths within a fraction of a second and firms up as the rest arrive.
+Chunks start small and double, so the first answer is quick and the
+later ones amortise the batched drawdown.
+
+    /simulations/1?kind=monte_carlo&paths=20000
+    /simulations/1?kind=backtest
+    /simulations/1?kind=grid&x=target_income:30000:80000:51&y=retirement_age:55:70:16
+
+Each chunk runs on the threadpool, so the event loop keeps serving other
+requests, and a closed page stops the run at the next chunk. The last
+event has id 'done' and the stream then closes; the browser reconnects
+with that id and gets a 204, which stops it rather than starting the run
+again.
+'''
+
+Kind = Literal['monte_carlo', 'backtest', 'grid']
+KINDS: dict[str, str] = {'monte_carlo': 'Monte Carlo', 'backtest': 'Backtest', 'grid': 'Grid'}
+PERCENTILES = (10, 25, 50, 75, 90)
+MAX_CHUNK = 4000
+# Last-Event-ID of a stream that has finished
+DONE = 'done'
+
+
+@dataclasses.dataclass
+class Run:
+    title: str
+    unit: str
+    total: int
+    first_chunk: int
+    evaluate: Callable[[int, int], Outcome]
+    # one per unit, to name the worst ones; None where they mean nothing (e.g. sampled paths)
+    labels: list[str] | None = None
+
+
+def chunks(total: int, first: int):
+    start, size = 0, first
+    while start < total:
+        yield start, min(start + size, total)
+        start += size
+        size = min(size * 2, MAX_CHUNK)
+
+
+def monte_carlo_run(cashflow_id: int, paths: int, seed: int) -> Run:
+    pots, incomes, params = read_scenario(cashflow_id)
+    scenario = build_scenario(pots, incomes, params)
+
+    @cache
+    def sampled():
+        # drawn on the first chunk and held by this run only
+        return sampled_paths(params.ticker, params.years, paths, seed)
+
+    def evaluate(start: int, stop: int) -> Outcome:
+        return simulate([scenario], sampled()[start:stop])
+
+    return Run(title=f'Monte Carlo, {paths} {params.ticker} paths', unit='paths', total=paths,
+               first_chunk=250, evaluate=evaluate)
+
+
+def backtest_run(cashflow_id: int) -> Run:
+    from .market import stock_returns
+
+    pots, incomes, params = read_scenario(cashflow_id)
+    stock = stock_returns()
+    check_market(params.ticker)
+    # the first year has no growth, and windows that run out of history can't be drawn down
+    starts = [y for y in range(int(stock.start) + 1, int(stock.end) - params.years + 1)
+              if not np.isnan(return_path(0, params.ticker, y, params.years)).any()]
+    if not starts:
+        raise HTTPException(status_code=422, detail=f"No {params.years} year windows in the history")
+    scenarios = [build_scenario(pots, incomes, params.model_copy(update={'growth': 0, 'historical_start_year': y}))
+                 for y in starts]
+
+    return Run(title=f'Backtest, every {params.years} year {params.ticker} window', unit='start years',
+               total=len(scenarios), first_chunk=4,
+               evaluate=lambda start, stop: simulate(scenarios[start:stop]),
+               labels=[str(y) for y in starts])
+
+
+def grid_run(cashflow_id: int, x: str, y: str) -> Run:
+    axes = (Axis.parse(x), Axis.parse(y))
+    if axes[0].field == axes[1].field:
+        raise HTTPException(status_code=422, detail="Each axis needs a different field")
+    cells = [(vx, vy) for vy in axes[1].values for vx in axes[0].values]
+    if len(cells) > MAX_CELLS:
+        raise HTTPException(status_code=422, detail=f"Grid has {len(cells)} cells, the limit is {MAX_CELLS}")
+
+    pots, incomes, params = read_scenario(cashflow_id)
+    ages = next((axis.values for axis in axes if axis.field == 'retirement_age'), (-1,))
+    bases = {int(age): build_scenario(pots, incomes, params if age < 0 else
+                                      params.model_copy(update={'retirement_age': int(age)}))
+             for age in ages}
+    scenarios = [cell_scenario(bases, axes, cell) for cell in cells]
+    # a window past the end of the history fails the request rather than a chunk of the stream
+    return_paths(scenarios, params.years)
+
+    return Run(title=f'Grid, {axes[0].field} by {axes[1].field}', unit='cells', total=len(scenarios),
+               first_chunk=250, evaluate=lambda start, stop: simulate(scenarios[start:stop]),
+               labels=[f'{axes[0].field} {axes[0].label(vx)}, {axes[1].field} {axes[1].label(vy)}'
+                       for vx, vy in cells])
+
+
+def make_run(cashflow_id: int, kind: Kind, paths: int = 10000, seed: int = 0,
+             x: str = 'target_income:30000:80000:51', y: str = 'retirement_age:55:70:16') -> Run:
+    if kind == 'monte_carlo':
+        return monte_carlo_run(cashflow_id, paths, seed)
+    if kind == 'backtest':
+        return backtest_run(cashflow_id)
+    return grid_run(cashflow_id, x, y)
+
+
+class Summary(BaseModel):
+    done: int
+    total: int
+    success_rate: float
+    final_balance: dict[int, float]     # by percentile
+    shortfall: dict[int, float]
+    worst: list[tuple[str, float]]      # (label, shortfall) of the worst failing units
+
+
+def summarise(run: Run, success: np.ndarray, final_balance: np.ndarray, shortfall: np.ndarray) -> Summary:
+    worst = []
+    if run.labels and not success.all():
+        worst = [(run.labels[n], round(float(shortfall[n]), 2))
+                 for n in np.argsort(final_balance - shortfall)[:5] if not success[n]]
+    return Summary(
+        done=len(success),
+        total=run.total,
+        success_rate=float(success.mean()),
+        final_balance=dict(zip(PERCENTILES, np.percentile(final_balance, PERCENTILES).round(2).tolist())),
+        shortfall=dict(zip(PERCENTILES, np.percentile(shortfall, PERCENTILES).round(2).tolist())),
+        worst=worst,
+    )
+
+
+def summaries(run: Run) -> Iterator[Summary]:
+    """A summary of everything evaluated so far after each chunk, the last one covering the whole run."""
+    success, final_balance, shortfall = [], [], []
+    for start, stop in chunks(run.total, run.first_chunk):
+        outcome = run.evaluate(start, stop)
+        success.append(outcome.success.ravel())
+        final_balance.append(outcome.final_balance.ravel())
+        shortfall.append(outcome.shortfall.ravel())
+        yield summarise(run, np.concatenate(success), np.concatenate(final_balance), np.concatenate(shortfall))
+
+
+def progress_components(run: Run, summary: Summary, milliseconds: float) -> list:
+    finished = summary.done == run.total
+    status = f"{'Finished' if finished else 'Running'}: {summary.done} of {run.total} {run.unit} in {milliseconds:.0f}ms"
+    table = '\n'.join(['| percentile | final balance | shortfall |', '|---:|---:|---:|'] +
+                      [f'| {p} | £{summary.final_balance[p]:,.0f} | £{summary.shortfall[p]:,.0f} |'
+                       for p in PERCENTILES])
+
+    components = [
+        c.Heading(text=run.title, level=3),
+        c.Paragraph(text=status),
+        c.Markdown(text=f'**{summary.success_rate:.1%}** of {run.unit} so far meet the target every year.\n\n{table}'),
+    ]
+    if summary.worst:
+        components.append(c.Markdown(text='Worst: ' + '; '.join(
+            f'{label} (£{shortfall:,.0f} short)' for label, shortfall in summary.worst)))
+    return components
+
+
+def event(components: list, event_id: str | None = None) -> bytes:
+    data = b'data: [' + b','.join(dump_component(component) for component in components) + b']\n\n'
+    return f'id: {event_id}\n'.encode() + data if event_id else data
+
+
+async def stream_run(run: Run):
+    started = time.perf_counter()
+    results = summaries(run)
+    try:
+        # one chunk at a time on the threadpool
+        while (summary := await run_in_threadpool(next, results, None)) is not None:
+            milliseconds = (time.perf_counter() - started) * 1000
+            yield event(progress_components(run, summary, milliseconds),
+                        DONE if summary.done == run.total else None)
+        logger.info(f"Streamed {run.title}: {run.total} {run.unit} in {milliseconds:.0f}ms")
+    except ValueError as e:
+        # unknown tickers and missing history, which only show up once the first chunk runs
+        yield event([c.Heading(text=run.title, level=3), c.Paragraph(text=str(e))], DONE)
+
+
+@router.get('/{cashflow_id:int}/stream')
+def simulation_stream(cashflow_id: int, kind: Kind = 'monte_carlo',
+                      paths: int = Query(default=10000, ge=10, le=200000), seed: int = 0,
+                      x: str = Query(default='target_income:30000:80000:51', description='field:start:stop:steps'),
+                      y: str = Query(default='retirement_age:55:70:16', description='field:start:stop:steps'),
+                      last_event_id: str | None = Header(default=None),
+                      ) -> Response:
+    if last_event_id == DONE:
+        # EventSource stops reconnecting on a 204
+        return Response(status_code=204)
+    try:
+        run = make_run(cashflow_id, kind, paths, seed, x, y)
+    except UnknownTicker as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return StreamingResponse(stream_run(run), media_type='text/event-stream')
+
+
+@router.get('/{cashflow_id:int}', response_model=FastUI, response_model_exclude_none=True)
+def simulations_view(cashflow_id: int, kind: Kind = 'monte_carlo') -> Response:
+    return demo_page_response(
+        c.LinkList(links=[c.Link(components=[c.Text(text=label)],
+                                 on_click=GoToEvent(url=f'/simulations/{cashflow_id}', query={'kind': name}),
+                                 active=name == kind)
+                          for name, label in KINDS.items()],
+                   mode='tabs', class_name='+ mb-4'),
+        c.ServerLoad(path=f'/simulations/{cashflow_id}/stream?kind={kind}', sse=True,
+                     components=[c.Paragraph(text='Starting…')]),
+        title='Simulations',
+    )
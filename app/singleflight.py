@@ -0,0 +1,48 @@
+from __future__ import annotations as _annotations
+
+import asyncio
+import logging
+from typing import Any, Callable, Hashable
+
+from fastapi.concurrency import run_in_threadpool
+
+from .metrics import FLIGHTS
+
+logger = logging.getLogger('cashflow')
+
+'''
+# Single flight
+======================================================================
+Identical requests that arrive while one is already being worked on wait
+for that one's result instead of repeating the DB reads, simulation,
+scrape or render:
+
+    cashflow_flight = SingleFlight('charts_cashflow')
+
+    html = await cashflow_flight.do(cashflow_id, cashflow_html, cashflow_id)
+
+The work runs on the threadpool as its own task, so a caller that goes
+away doesn't cancel it for the others, and an exception reaches every
+caller. Nothing is kept once the call finishes; this only merges requests
+that overlap. Calls and merged calls per flight are reported at /metrics.
+'''
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self.calls: dict[Hashable, asyncio.Future] = {}
+        self.started = 0
+        self.coalesced = 0
+        FLIGHTS[name] = self
+
+    async def do(self, key: Hashable, fn: Callable[..., Any], *args) -> Any:
+        call = self.calls.get(key)
+        if call is None:
+            self.started += 1
+            call = self.calls[key] = asyncio.ensure_future(run_in_threadpool(fn, *args))
+            call.add_done_callback(lambda _: self.calls.pop(key, None))
+        else:
+            self.coalesced += 1
+            logger.debug("Joined %s call in flight for %s", self.name, key)
+        return await asyncio.shield(call)
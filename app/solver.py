@@ -0,0 +1,186 @@
+from __future__ import annotations as _annotations
+
+import dataclasses
+import logging
+import time
+from typing import Literal
+
+import numpy as np
+from fastapi import APIRouter, HTTPException, Query
+from pydantic import BaseModel
+
+from .charts import read_scenario
+from .closes import UnknownTicker
+from .engine import Scenario, build_scenario, return_path, sampled_paths, simulate
+from .portfolio import check_market
+
+logger = logging.getLogger('cashflow')
+router = APIRouter()
+
+'''
+# Solver
+======================================================================
+Finds the highest target_income, or the earliest retirement_age, at which
+the pots cover the need for every year. Each pass runs CANDIDATES values
+through one batched drawdown and narrows the range to the gap between the
+last value that passes and the first that fails, so income converges to
+the nearest pound in a handful of passes.
+
+    deterministic  the cashflow's fixed growth rate
+    historical     the returns from historical_start_year onwards
+    monte_carlo    bootstrapped return paths; a value passes when at least
+                   `percentile` percent of the paths succeed
+'''
+
+CANDIDATES = 32
+MAX_PASSES = 20
+MAX_RETIREMENT_YEARS = 40
+# sampled paths each candidate is run against in monte_carlo mode
+MAX_PATHS = 10_000
+# scenarios x paths x pots x years in one batched drawdown, so each of its arrays stays around 32MB
+CHUNK_VALUES = 4_000_000
+
+SolveFor = Literal['target_income', 'retirement_age']
+Mode = Literal['deterministic', 'historical', 'monte_carlo']
+
+
+class SolverResult(BaseModel):
+    cashflow_id: int
+    solve_for: SolveFor
+    mode: Mode
+    percentile: float
+    value: float | None = None       # None when no candidate succeeds
+    success_rate: float
+    passes: int
+    evaluated: int
+    milliseconds: float
+
+
+@dataclasses.dataclass
+class Solver:
+    mode: Mode
+    percentile: float
+    paths: np.ndarray | None = None
+    passes: int = 0
+    evaluated: int = 0
+
+    def success_rates(self, scenarios: list[Scenario]) -> np.ndarray:
+        self.passes += 1
+        self.evaluated += len(scenarios)
+        runs = len(self.paths) if self.paths is not None else 1
+        chunk = max(1, CHUNK_VALUES // (runs * scenarios[0].years * max(len(scenarios[0].pots), 1)))
+        rates = []
+        for n in range(0, len(scenarios), chunk):
+            outcome = simulate(scenarios[n:n + chunk], self.paths)
+            success = outcome.success if self.paths is not None else outcome.success[:, np.newaxis]
+            rates.append(success.mean(axis=1))
+        return np.concatenate(rates)
+
+    def passing(self, rates: np.ndarray) -> np.ndarray:
+        # a small epsilon so 90% of 1000 paths is not lost to float rounding
+        return rates >= self.percentile / 100 - 1e-9
+
+    def max_income(self, base: Scenario, tolerance: float) -> tuple[float | None, float]:
+        lo_rate = self.success_rates([dataclasses.replace(base, target_income=0.0)])[0]
+        if not self.passing(lo_rate):
+            return None, float(lo_rate)
+
+        # grow the upper bound until it fails
+        lo, hi = 0.0, max(base.target_income, sum(p.amount for p in base.pots) / max(base.years, 1), 1000.0)
+        while self.passes < MAX_PASSES:
+            rates = self.success_rates([dataclasses.replace(base, target_income=hi * 2 ** n)
+                                        for n in range(CANDIDATES // 4)])
+            ok = self.passing(rates)
+            if not ok.all():
+                first_fail = int(np.argmin(ok))
+                if first_fail:
+                    lo, lo_rate = hi * 2 ** (first_fail - 1), rates[first_fail - 1]
+                hi = hi * 2 ** first_fail
+                break
+            lo, lo_rate, hi = hi * 2 ** (len(ok) - 1), rates[-1], hi * 2 ** len(ok)
+
+        while hi - lo > tolerance and self.passes < MAX_PASSES:
+            candidates = np.linspace(lo, hi, CANDIDATES + 2)[1:-1]
+            rates = self.success_rates([dataclasses.replace(base, target_income=float(v)) for v in candidates])
+            ok = self.passing(rates)
+            # success only falls as income rises, so take the last pass and the first fail after it
+            last = int(np.flatnonzero(ok)[-1]) if ok.any() else -1
+            if last >= 0:
+                lo, lo_rate = float(candidates[last]), rates[last]
+            if last + 1 < len(candidates):
+                hi = float(candidates[last + 1])
+
+        return float(np.floor(lo / tolerance) * tolerance), float(lo_rate)
+
+    def earliest_retirement(self, bases: list[Scenario]) -> tuple[float | None, float]:
+        rates = self.success_rates(bases)
+        ok = np.flatnonzero(self.passing(rates))
+        if not len(ok):
+            return None, float(rates.max())
+        first = int(ok[0])
+        return float(bases[first].retirement_age), float(rates[first])
+
+
+def solve(cashflow_id: int, solve_for: SolveFor, mode: Mode, percentile: float = 100.0,
+          paths: int = 1000, seed: int = 0, historical_start_year: int | None = None,
+          tolerance: float = 1.0) -> SolverResult:
+    start = time.perf_counter()
+    pots, incomes, params = read_scenario(cashflow_id)
+    if not pots:
+        raise HTTPException(status_code=422, detail=f"Cashflow {cashflow_id} has no pots")
+
+    update = {}
+    if mode == 'deterministic':
+        if params.growth <= 0:
+            raise HTTPException(status_code=422, detail="Deterministic mode needs a growth rate above zero")
+        percentile = 100.0
+    elif mode == 'historical':
+        update['growth'] = 0.0
+        if historical_start_year is not None:
+            update['historical_start_year'] = historical_start_year
+        percentile = 100.0
+    params = params.model_copy(update=update)
+
+    solver = Solver(mode=mode, percentile=percentile)
+    if mode == 'monte_carlo':
+        if paths > MAX_PATHS:
+            raise HTTPException(status_code=422, detail=f"The solver samples at most {MAX_PATHS} paths")
+        try:
+            solver.paths = sampled_paths(params.ticker, params.years, paths, seed)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+    elif mode == 'historical':
+        try:
+            check_market(params.ticker)
+            path = return_path(params.growth, params.ticker, params.historical_start_year, params.years)
+        except UnknownTicker as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        if len(path) < params.years or np.isnan(path).any():
+            raise HTTPException(status_code=422, detail=f"Not enough {params.ticker} history for {params.years} "
+                                                        f"years from {params.historical_start_year}")
+
+    if solve_for == 'target_income':
+        value, rate = solver.max_income(build_scenario(pots, incomes, params), tolerance)
+    else:
+        ages = range(params.age, params.age + MAX_RETIREMENT_YEARS + 1)
+        value, rate = solver.earliest_retirement([
+            build_scenario(pots, incomes, params.model_copy(update={'retirement_age': age})) for age in ages])
+
+    result = SolverResult(cashflow_id=cashflow_id, solve_for=solve_for, mode=mode, percentile=percentile,
+                          value=value, success_rate=rate, passes=solver.passes, evaluated=solver.evaluated,
+                          milliseconds=round((time.perf_counter() - start) * 1000, 1))
+    logger.info(f"Solved {solve_for} for cashflow {cashflow_id} ({mode}): {value} "
+                f"in {result.passes} passes, {result.milliseconds}ms")
+    return result
+
+
+@router.get('/{cashflow_id:int}', response_model=SolverResult)
+def solve_cashflow(cashflow_id: int,
+                   solve_for: SolveFor = 'target_income',
+                   mode: Mode = 'deterministic',
+                   percentile: float = Query(default=90.0, gt=0, le=100,
+                                             description='Monte Carlo paths that must succeed, in percent'),
+                   paths: int = Query(default=1000, ge=10, le=MAX_PATHS),
+                   seed: int = 0,
+                   historical_start_year: int | None = None) -> SolverResult:
+    return solve(cashflow_id, solve_for, mode, percentile, paths, seed, historical_start_year)
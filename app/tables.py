@@ -1,6 +1,5 @@
 from datetime import date
 from functools import cache
-from pathlib import Path
 
 import pydantic
 from fastapi import APIRouter
@@ -8,19 +7,22 @@ from fastui import AnyComponent, FastUI
 from fastui import components as c
 from fastui.components.display import DisplayLookup, DisplayMode
 from fastui.events import BackEvent, GoToEvent, PageEvent
-from pydantic import BaseModel, Field, TypeAdapter
+from pydantic import BaseModel, Field
 
 from sqlalchemy import Numeric, Column, Integer, String, Date, Float
 from sqlalchemy.orm import DeclarativeBase
 
 from datetime import datetime
 
-from .shared import demo_page
+from .shared import demo_page_response, dump_component, table_json
+from .env import ENV
+from .cities import cities_store
 from .gilts import read_gilts, PyGilt, last_refresh
 
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response
 
 router = APIRouter()
+env = ENV()
 
 
 class City(BaseModel):
@@ -63,26 +65,12 @@ class Gilt(Base):
     calculated_yield = Column(Numeric(6, 2))
 
 
-@cache
-def cities_list() -> list[City]:
-    cities_adapter = TypeAdapter(list[City])
-    cities_file = Path(__file__).parent / 'cities.json'
-    cities = cities_adapter.validate_json(cities_file.read_bytes())
-    cities.sort(key=lambda city: city.population, reverse=True)
-    return cities
-
-
-@cache
-def cities_lookup() -> dict[id, City]:
-    return {city.id: city for city in cities_list()}
-
-
 class FilterForm(pydantic.BaseModel):
     country: str = Field(json_schema_extra={'search_url': '/api/forms/search', 'placeholder': 'Filter by Country...'})
 
 
 @router.get('/gilts', response_model=FastUI, response_model_exclude_none=True)
-def gilts_view(page: int = 1, country: str | None = None) -> list[AnyComponent]:
+def gilts_view(page: int = 1, country: str | None = None) -> Response:
 
     jpgilt = PyGilt(gilt_id=1,
     close_of_business_date = datetime.now(),
@@ -106,15 +94,9 @@ def gilts_view(page: int = 1, country: str | None = None) -> list[AnyComponent]:
     calculated_yield= 10,
                     )
 
-    gilts = []
-    pygilts = []
-
     gilts = read_gilts()
-    for g in gilts:
-        pygilts.append(db_to_pydantic(g))
-
 
-    # gilts.append(jpgilt)
+    # gilts.append(jpgilt)
     page_size = 50
     filter_form_initial = {}
     """
@@ -124,8 +106,31 @@ def gilts_view(page: int = 1, country: str | None = None) -> list[AnyComponent]:
         country_name = cities[0].country if cities else country
         filter_form_initial['country'] = {'value': country, 'label': country_name}
     """
-    return demo_page(
-        *tabs(),
+    page_gilts = gilts[(page - 1) * page_size : page * page_size]
+    columns=[
+        DisplayLookup(field='instrument_type', table_width_percent=5),
+        DisplayLookup(field='maturity_bracket', table_width_percent=5),
+        DisplayLookup(field='instrument_name', table_width_percent=5),
+        DisplayLookup(field='isin_code',  on_click=GoToEvent(url='./{isin_code}'), table_width_percent=5),
+        DisplayLookup(field='ticker', table_width_percent=5),
+        DisplayLookup(field='redemption_date', table_width_percent=5),
+        DisplayLookup(field='dividend_dates', table_width_percent=5),
+        DisplayLookup(field='current_ex_div_date', table_width_percent=5),
+        DisplayLookup(field='coupon', table_width_percent=5),
+        DisplayLookup(field='days_to_redemption', table_width_percent=5),
+        DisplayLookup(field='years_to_redemption', table_width_percent=5),
+        DisplayLookup(field='clean_price', table_width_percent=5),
+        DisplayLookup(field='dirty_price', table_width_percent=5),
+        DisplayLookup(field='tradeweb_yield', table_width_percent=5),
+        DisplayLookup(field='calculated_yield', table_width_percent=5)
+    ]
+    if env.fast_json:
+        table = table_json(PyGilt, page_gilts, columns=columns)
+    else:
+        table = c.Table(data_model=PyGilt, data=[db_to_pydantic(g) for g in page_gilts], columns=columns)
+
+    return demo_page_response(
+        tabs_json(),
         c.ModelForm(model=FilterForm,
             submit_url='.',
             initial=filter_form_initial,
@@ -133,39 +138,20 @@ def gilts_view(page: int = 1, country: str | None = None) -> list[AnyComponent]:
             submit_on_change=True,
             display_mode='inline',
         ),
-        c.Table(data_model=PyGilt,
-            data=pygilts[(page - 1) * page_size : page * page_size],
-            columns=[
-                DisplayLookup(field='instrument_type', table_width_percent=5),
-                DisplayLookup(field='maturity_bracket', table_width_percent=5),
-                DisplayLookup(field='instrument_name', table_width_percent=5),
-                DisplayLookup(field='isin_code',  on_click=GoToEvent(url='./{isin_code}'), table_width_percent=5),
-                DisplayLookup(field='ticker', table_width_percent=5),
-                DisplayLookup(field='redemption_date', table_width_percent=5),
-                DisplayLookup(field='dividend_dates', table_width_percent=5),
-                DisplayLookup(field='current_ex_div_date', table_width_percent=5),
-                DisplayLookup(field='coupon', table_width_percent=5),
-                DisplayLookup(field='days_to_redemption', table_width_percent=5),
-                DisplayLookup(field='years_to_redemption', table_width_percent=5),
-                DisplayLookup(field='clean_price', table_width_percent=5),
-                DisplayLookup(field='dirty_price', table_width_percent=5),
-                DisplayLookup(field='tradeweb_yield', table_width_percent=5),
-                DisplayLookup(field='calculated_yield', table_width_percent=5)
-            ],
-        ),
-        c.Pagination(page=page, page_size=page_size, total=len(pygilts)),
+        table,
+        c.Pagination(page=page, page_size=page_size, total=len(gilts)),
         title='Gilts',
     )
 
 @router.get('/yieldcurve', response_model=FastUI, response_model_exclude_none=True)
-def yieldcurve_view():
+def yieldcurve_view() -> Response:
 
     last_refresh_time = last_refresh().strftime('%A, %d %b %Y')
 
     text = f"Last time prices refreshed: {last_refresh_time}"
 
-    return demo_page(
-        *tabs(),
+    return demo_page_response(
+        tabs_json(),
         c.Button(text='Load new prices', on_click=PageEvent(name='server-load')),
         c.Div(
             components=[c.ServerLoad(
@@ -179,18 +165,31 @@ def yieldcurve_view():
         )
 
 @router.get('/cities', response_model=FastUI, response_model_exclude_none=True)
-def cities_view(page: int = 1, country: str | None = None):
-    cities = cities_list()
+def cities_view(page: int = 1, country: str | None = None) -> Response:
+    store = cities_store()
+    rows = store.by_population
     page_size = 50
     filter_form_initial = {}
     if country:
-        cities = [city for city in cities if city.iso3 == country]
-        country_name = cities[0].country if cities else country
+        rows = store.country_rows(country)
+        country_name = store.country_name(country) or country
         filter_form_initial['country'] = {'value': country, 'label': country_name}
 
+    # only the rows on this page become City models
+    page_cities = store.rows(rows[(page - 1) * page_size : page * page_size])
+    columns=[
+        DisplayLookup(field='city', on_click=GoToEvent(url='./{id}'), table_width_percent=33),
+        DisplayLookup(field='country', table_width_percent=33),
+        DisplayLookup(field='population', table_width_percent=33),
+    ]
+    if env.fast_json:
+        table = table_json(City, page_cities, columns=columns)
+    else:
+        table = c.Table(data_model=City, data=[City(**row) for row in page_cities], columns=columns)
+
 
-    return demo_page(
-        *tabs(),
+    return demo_page_response(
+        tabs_json(),
         c.ModelForm(model=FilterForm,
             submit_url='.',
             initial=filter_form_initial,
@@ -198,23 +197,16 @@ def cities_view(page: int = 1, country: str | None = None):
             submit_on_change=True,
             display_mode='inline',
         ),
-        c.Table(data_model=City,
-            data=cities[(page - 1) * page_size : page * page_size],
-            columns=[
-                DisplayLookup(field='city', on_click=GoToEvent(url='./{id}'), table_width_percent=33),
-                DisplayLookup(field='country', table_width_percent=33),
-                DisplayLookup(field='population', table_width_percent=33),
-            ],
-        ),
-        c.Pagination(page=page, page_size=page_size, total=len(cities)),
+        table,
+        c.Pagination(page=page, page_size=page_size, total=len(rows)),
         title='Cities',
         )
 
 @router.get('/cities/{city_id}', response_model=FastUI, response_model_exclude_none=True)
-def city_view(city_id: int) -> list[AnyComponent]:
-    city = cities_lookup()[city_id]
-    return demo_page(
-        *tabs(),
+def city_view(city_id: int) -> Response:
+    city = City(**cities_store().lookup(city_id))
+    return demo_page_response(
+        tabs_json(),
         c.Link(components=[c.Text(text='Back')], on_click=BackEvent()),
         c.Details(data=city),
         title=city.city,
@@ -236,9 +228,9 @@ users: list[User] = [
 
 
 @router.get('/users', response_model=FastUI, response_model_exclude_none=True)
-def users_view() -> list[AnyComponent]:
-    return demo_page(
-        *tabs(),
+def users_view() -> Response:
+    return demo_page_response(
+        tabs_json(),
         c.Table(data_model=User,
             data=users,
             columns=[
@@ -278,11 +270,16 @@ def tabs() -> list[AnyComponent]:
     ]
 
 
+@cache
+def tabs_json() -> bytes:
+    return b','.join(dump_component(tab) for tab in tabs())
+
+
 @router.get('/users/{id}/', response_model=FastUI, response_model_exclude_none=True)
-def user_profile(id: int) -> list[AnyComponent]:
+def user_profile(id: int) -> Response:
     user: User | None = users[id - 1] if id <= len(users) else None
-    return demo_page(
-        *tabs(),
+    return demo_page_response(
+        tabs_json(),
         c.Link(components=[c.Text(text='Back')], on_click=BackEvent()),
         c.Details(
             data=user,
@@ -0,0 +1,114 @@
+"""
+Synthetic stand-ins for the benchmarks: cashflows with pots and incomes, a
+gilt universe and a daily price series in the shape yfinance returns.
+
+Nothing here touches the network. The database is an SQLite file unless a
+(scratch) Postgres URL is given, whose cashflow and gilt tables are
+recreated.
+"""
+from __future__ import annotations as _annotations
+
+import datetime as dt
+import random
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, insert
+
+TICKERS = ('^GSPC', '^FTSE')
+POT_TYPES = ('pension', 'isa', 'savings')
+INSTRUMENT_TYPES = ('Conventional ', 'Index-linked ')
+
+
+def price_history(tickers=TICKERS, start: str = '1970-01-01', end: str = '2023-01-01', seed: int = 0) -> pd.DataFrame:
+    """Daily closes as a random walk, columns (ticker, 'Close') like yf.download(group_by='ticker')."""
+    rng = np.random.default_rng(seed)
+    days = pd.bdate_range(start, end, inclusive='left')
+    closes = {(ticker, 'Close'): 100 * np.exp(np.cumsum(rng.normal(0.0003, 0.011, len(days))))
+              for ticker in tickers}
+    return pd.DataFrame(closes, index=days)
+
+
+def install_prices(stock, prices: pd.DataFrame, directory: Path):
+    """Write prices as closes files in directory, so the stock maps them instead of downloading."""
+    from app.closes import frame_closes, ticker_path, write_closes
+
+    directory.mkdir(parents=True, exist_ok=True)
+    dates, columns = frame_closes(prices)
+    for ticker, closes in columns.items():
+        traded = ~np.isnan(closes)
+        write_closes(ticker_path(ticker, directory), dates[traded], {ticker: closes[traded]})
+    stock.directory = directory
+    stock.mapped.clear()
+
+
+def cashflow_rows(cashflows: int, pots: int, incomes: int, seed: int = 0) -> dict[str, list[dict]]:
+    rnd = random.Random(seed)
+    rows = {'cashflow': [], 'pots': [], 'incomes': [], 'parameters': []}
+    for cashflow_id in range(1, cashflows + 1):
+        rows['cashflow'].append({'cashflow_id': cashflow_id, 'name': f'cashflow {cashflow_id}', 'description': ''})
+        for n in range(pots):
+            rows['pots'].append({'cashflow_id': cashflow_id, 'name': f'Pot{n + 1}', 'type': POT_TYPES[n % 3],
+                                 'amount': float(rnd.randrange(20, 800) * 1000)})
+        for n in range(incomes):
+            rows['incomes'].append({'cashflow_id': cashflow_id, 'name': f'Income{n + 1}', 'type': 'Pension',
+                                    'amount': float(rnd.randrange(2, 15) * 1000), 'inflation_yearly': True,
+                                    'repeating_yearly': True,
+                                    'start_date': dt.date(2026 + rnd.randrange(0, 15), rnd.randrange(1, 13), 1)})
+        rows['parameters'].append({'cashflow_id': cashflow_id, 'target_income': rnd.randrange(30, 80) * 1000,
+                                   'inflation': 3, 'growth': 5, 'age': 55, 'retirement_age': 60, 'years': 30,
+                                   'ticker': '^GSPC', 'historical_start_year': 1980, 'charges': 0.5})
+    return rows
+
+
+def gilt_rows(count: int, seed: int = 0) -> list[dict]:
+    rnd = random.Random(seed)
+    cob = dt.date(2024, 3, 7)
+    gilts = []
+    for n in range(count):
+        years = rnd.uniform(0.1, 50)
+        coupon = round(rnd.uniform(0.125, 6), 3)
+        redemption = cob + dt.timedelta(days=int(years * 365))
+        gilts.append({
+            'close_of_business_date': cob,
+            'instrument_type': INSTRUMENT_TYPES[n % 7 == 0] + 'Gilt',
+            'maturity_bracket': 'Short' if years < 7 else 'Medium' if years < 15 else 'Long',
+            'instrument_name': f'{coupon}% Treasury Gilt {redemption.year}',
+            'isin_code': f'GB00B{n:07d}',
+            'ticker': f'T{redemption.year % 100:02d}{chr(65 + n % 26)}',
+            'redemption_date': redemption,
+            'first_issue_date': cob - dt.timedelta(days=rnd.randrange(100, 9000)),
+            'dividend_dates': '7-Mar/7-Sep',
+            'current_ex_div_date': cob - dt.timedelta(days=10),
+            'total_amount_in_issue': float(rnd.randrange(1000, 40000)),
+            'total_amount_including_il_uplift': float(rnd.randrange(1000, 40000)),
+            'coupon': coupon,
+            'days_to_redemption': int(years * 365),
+            'years_to_redemption': round(years, 2),
+            'clean_price': round(rnd.uniform(40, 120), 2),
+            'dirty_price': round(rnd.uniform(40, 120), 2),
+            'tradeweb_yield': round(rnd.uniform(3, 5), 2),
+            'calculated_yield': round(rnd.uniform(3, 5), 2),
+        })
+    return gilts
+
+
+def create_database(url: str, cashflows: int = 10, pots: int = 4, incomes: int = 4, gilts: int = 60,
+                    seed: int = 0) -> str:
+    """(Re)create the app's tables at url and fill them with synthetic rows."""
+    from app.dao import Base as CashflowBase, Cashflow, Income, Parameters, Pot
+    from app.gilts import Base as GiltBase, Gilt
+
+    engine = create_engine(url)
+    for base in (CashflowBase, GiltBase):
+        base.metadata.drop_all(engine)
+        base.metadata.create_all(engine)
+
+    rows = cashflow_rows(cashflows, pots, incomes, seed)
+    with engine.begin() as connection:
+        for model in (Cashflow, Pot, Income, Parameters):
+            connection.execute(insert(model), rows[model.__tablename__])
+        connection.execute(insert(Gilt), gilt_rows(gilts, seed))
+    engine.dispose()
+    return url
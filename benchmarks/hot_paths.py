@@ -0,0 +1,228 @@
+"""
+Hot path benchmark: simulation, chart rendering, DAO queries and page
+serialisation, each stage timed on its own against synthetic fixtures.
+
+    python -m benchmarks.hot_paths [--runs 20] [--gilts 60] [--pots 4] [--incomes 4]
+                                   [--database-url postgresql://...] [--output results.json]
+                                   [--compare previous.json]
+
+Results are JSON with one entry per stage; --compare prints the change
+against an earlier run, e.g. one taken on another commit. Spans such as
+render.cashflow/fig_to_html are the time spent inside that call during
+the parent stage.
+"""
+from __future__ import annotations as _annotations
+
+import argparse
+import contextlib
+import dataclasses
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from benchmarks.fixtures import create_database, install_prices, price_history
+from benchmarks.stats import percentile
+
+
+@dataclasses.dataclass
+class Stage:
+    name: str
+    run: callable
+    # (module, attribute) calls timed inside the stage
+    spans: dict[str, tuple[object, str]] = dataclasses.field(default_factory=dict)
+    setup: callable = None
+
+
+@contextlib.contextmanager
+def timed_spans(spans: dict[str, tuple[object, str]], totals: dict[str, float]):
+    originals = {}
+    for name, (owner, attribute) in spans.items():
+        original = originals[name] = getattr(owner, attribute)
+
+        def wrapper(*args, _name=name, _original=original, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _original(*args, **kwargs)
+            finally:
+                totals[_name] += (time.perf_counter() - start) * 1000
+
+        setattr(owner, attribute, wrapper)
+    try:
+        yield
+    finally:
+        for name, (owner, attribute) in spans.items():
+            setattr(owner, attribute, originals[name])
+
+
+def summary(name: str, timings: list[float]) -> dict:
+    return {
+        'stage': name,
+        'runs': len(timings),
+        'p50_ms': round(statistics.median(timings), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'min_ms': round(min(timings), 3),
+    }
+
+
+def measure(stage: Stage, runs: int) -> list[dict]:
+    timings = []
+    span_timings = defaultdict(list)
+    for n in range(runs + 1):
+        if stage.setup:
+            stage.setup()
+        totals = defaultdict(float)
+        with timed_spans(stage.spans, totals):
+            start = time.perf_counter()
+            stage.run()
+            elapsed = (time.perf_counter() - start) * 1000
+        if n == 0:
+            continue    # warm up connections, imports and the matplotlib font cache
+        timings.append(elapsed)
+        for span in stage.spans:
+            span_timings[span].append(totals[span])
+
+    return [summary(stage.name, timings)] + [summary(f'{stage.name}/{span}', span_timings[span])
+                                             for span in stage.spans]
+
+
+def stages(cashflow_id: int, grid_cells: int) -> list[Stage]:
+    # the app reads DATABASE_URL on import, so only import it once run() has set it
+    import mpld3
+
+    from app import cashflow, engine, gilts, tables
+    from app.charts import read_scenario
+    from app.dao import read_incomes, read_parameters, read_pots, scenario_cache
+    from app.market import stock_returns
+
+    pots, incomes, params = read_scenario(cashflow_id)
+    scenario = engine.build_scenario(pots, incomes, params)
+    projection = engine.project(scenario)
+    grid = [dataclasses.replace(scenario, target_income=20000 + n * 50) for n in range(grid_cells)]
+
+    def clear_engine_caches():
+        for cache in engine.CACHES:
+            cache.cache_clear()
+
+    def tooltips():
+        ages = projection.ages.tolist()
+        pot_rows = [cashflow.Pot(label=label, start=int(projection.amounts[n][0]),
+                                 yearly_limit=engine.yearly_limit(projection.amounts[n][0]),
+                                 amount=projection.amounts[n].tolist(), spent=projection.spent[n].tolist())
+                    for n, label in enumerate(projection.pot_labels)]
+        income_rows = [cashflow.Income(yearly=i.amount, cpi=scenario.inflation, years_in=i.years_in,
+                                       repeating_years=0, label=i.label, amount=projection.incomes[n].tolist())
+                       for n, i in enumerate(scenario.incomes)]
+        for year in range(scenario.years):
+            cashflow.pot_bar_hover_table(year, scenario.pot_start_date, ages[year], pot_rows,
+                                         projection.growth[year], scenario.inflation, '')
+            cashflow.spend_bar_hover_table(year, scenario.pot_start_date, ages[year], pot_rows,
+                                           income_rows, projection.drawn_down[year])
+
+    return [
+        # each read loads the cashflow's rows afresh, rather than finding them in the scenario cache
+        Stage('query.read_pots', lambda: read_pots(cashflow_id), setup=scenario_cache.cache_clear),
+        Stage('query.read_incomes', lambda: read_incomes(cashflow_id), setup=scenario_cache.cache_clear),
+        Stage('query.read_parameters', lambda: read_parameters(cashflow_id), setup=scenario_cache.cache_clear),
+        Stage('query.read_scenario', lambda: read_scenario(cashflow_id), setup=scenario_cache.cache_clear),
+        Stage('cache.read_scenario', lambda: read_scenario(cashflow_id)),
+        Stage('query.read_gilts', gilts.read_gilts),
+        Stage('query.gilt_image_data', gilts.generate_image_data),
+        Stage('market.get_yearly_returns',
+              lambda: stock_returns().get_yearly_returns(start=params.historical_start_year, years=params.years,
+                                                       ticker=params.ticker)),
+        Stage('simulate.project', lambda: engine.project(scenario), setup=clear_engine_caches),
+        Stage(f'simulate.grid_{grid_cells}', lambda: engine.simulate(grid), setup=clear_engine_caches),
+        Stage('render.tooltips', tooltips),
+        Stage('render.cashflow', lambda: cashflow.render_projection(projection),
+              spans={'fig_to_html': (mpld3, 'fig_to_html'),
+                     'pot_tooltips': (cashflow, 'pot_bar_hover_table'),
+                     'spend_tooltips': (cashflow, 'spend_bar_hover_table')}),
+        Stage('render.gilts', gilts.create_image,
+              spans={'query': (gilts, 'generate_image_data'),
+                     'fig_to_html': (mpld3, 'fig_to_html')}),
+        Stage('serialise.gilts_view', lambda: tables.gilts_view(page=1).body,
+              spans={'query': (tables, 'read_gilts')}),
+        Stage('serialise.cities_view', lambda: tables.cities_view(page=1).body),
+    ]
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> dict:
+    workdir = Path(tempfile.mkdtemp(prefix='cashflow-bench-'))
+    url = args.database_url or f"sqlite:///{workdir / 'bench.db'}"
+    os.environ['DATABASE_URL'] = url
+    create_database(url, cashflows=args.cashflows, pots=args.pots, incomes=args.incomes, gilts=args.gilts)
+
+    from app.market import stock_returns
+    install_prices(stock_returns(), price_history(), workdir / 'market-data')
+
+    # create_image() writes static/temp.html relative to the working directory
+    (workdir / 'static').mkdir()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        results = []
+        for stage in stages(cashflow_id=1, grid_cells=args.grid):
+            results.extend(measure(stage, args.runs))
+    finally:
+        os.chdir(cwd)
+
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'database': url.split(':', 1)[0],
+        'config': {'runs': args.runs, 'gilts': args.gilts, 'pots': args.pots, 'incomes': args.incomes,
+                   'cashflows': args.cashflows, 'grid': args.grid},
+        'results': results,
+    }
+
+
+def compare(results: dict, previous: dict):
+    before = {r['stage']: r for r in previous['results']}
+    print(f"\n{'stage':<40} {previous.get('commit') or 'before':>10} {results.get('commit') or 'after':>10}  change")
+    for r in results['results']:
+        if r['stage'] in before and before[r['stage']]['p50_ms']:
+            old = before[r['stage']]['p50_ms']
+            print(f"{r['stage']:<40} {old:10.3f} {r['p50_ms']:10.3f}  {(r['p50_ms'] - old) / old:+.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--cashflows', type=int, default=10)
+    parser.add_argument('--pots', type=int, default=4)
+    parser.add_argument('--incomes', type=int, default=4)
+    parser.add_argument('--gilts', type=int, default=60)
+    parser.add_argument('--grid', type=int, default=1000, help='scenarios in the batched simulate stage')
+    parser.add_argument('--database-url', help='scratch database to load the fixtures into (default: SQLite)')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='earlier --output file to compare against')
+    args = parser.parse_args()
+
+    results = run(args)
+    for r in results['results']:
+        print(f"{r['stage']:<40} p50 {r['p50_ms']:9.3f} ms  p99 {r['p99_ms']:9.3f} ms")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
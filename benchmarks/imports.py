@@ -0,0 +1,75 @@
+"""
+Import time report: runs `python -X importtime -c "import app"` in a fresh
+interpreter and lists the slowest modules by cumulative import time.
+
+    python -m benchmarks.imports [--module app] [--top 25] [--runs 3] [--output imports.json]
+
+The app is imported with DATABASE_URL pointing at an in-memory SQLite
+database so no server is needed; nothing connects at import time.
+"""
+from __future__ import annotations as _annotations
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def import_times(module: str) -> list[dict]:
+    env = {**os.environ, 'DATABASE_URL': os.environ.get('DATABASE_URL', 'sqlite://')}
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, env=env, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if match := LINE.match(line):
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append({'module': name, 'depth': len(indent) // 2,
+                            'self_ms': int(self_us) / 1000, 'cumulative_ms': int(cumulative_us) / 1000})
+    return modules
+
+
+def run(module: str, runs: int, top: int) -> dict:
+    samples = [import_times(module) for _ in range(runs)]
+    totals = [next(m['cumulative_ms'] for m in reversed(s) if m['module'] == module) for s in samples]
+
+    # report the run closest to the median
+    median = statistics.median(totals)
+    modules = samples[min(range(runs), key=lambda n: abs(totals[n] - median))]
+    loaded = {m['module'].split('.')[0] for m in modules}
+
+    return {
+        'module': module,
+        'runs': runs,
+        'total_ms': round(median, 1),
+        'modules_loaded': len(modules),
+        'heavy_loaded': sorted(loaded & {'matplotlib', 'mpld3', 'pandas', 'yfinance', 'pandas_datareader',
+                                         'lxml', 'numpy', 'requests'}),
+        'slowest': sorted(modules, key=lambda m: -m['cumulative_ms'])[:top],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--module', default='app')
+    parser.add_argument('--top', type=int, default=25)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    report = run(args.module, args.runs, args.top)
+    print(f"import {report['module']}: {report['total_ms']:.1f} ms (median of {report['runs']}), "
+          f"{report['modules_loaded']} modules, heavy: {', '.join(report['heavy_loaded']) or 'none'}")
+    for m in report['slowest']:
+        print(f"{m['cumulative_ms']:10.1f} ms {m['self_ms']:9.1f} ms  {'  ' * m['depth']}{m['module']}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Table response benchmark: FastAPI response_model validation vs the
+pre-serialised path in app.shared, for 50, 500 and 5000 row tables.
+
+    python -m benchmarks.tables [--requests 200] [--output results.json]
+"""
+from __future__ import annotations as _annotations
+
+import argparse
+import json
+import statistics
+import time
+
+from fastapi import FastAPI
+from fastapi.responses import Response
+from fastapi.testclient import TestClient
+from fastui import AnyComponent, FastUI
+from fastui import components as c
+from fastui.components.display import DisplayLookup
+
+from app.cities import cities_store
+from app.shared import demo_page, demo_page_response, table_json
+from app.tables import City
+from benchmarks.stats import percentile
+
+SIZES = (50, 500, 5000)
+
+COLUMNS = [
+    DisplayLookup(field='city', table_width_percent=33),
+    DisplayLookup(field='country', table_width_percent=33),
+    DisplayLookup(field='population', table_width_percent=33),
+]
+
+
+def synthetic_cities(count: int) -> list[City]:
+    store = cities_store()
+    cities = []
+    for n in range(count):
+        row = store.row(n % len(store))
+        row['id'] = n
+        cities.append(City(**row))
+    return cities
+
+
+def build_app(cities: list[City]) -> FastAPI:
+    app = FastAPI()
+
+    @app.get('/default/{rows}', response_model=FastUI, response_model_exclude_none=True)
+    def default_table(rows: int) -> list[AnyComponent]:
+        return demo_page(c.Table(data_model=City, data=cities[:rows], columns=COLUMNS), title='Cities')
+
+    @app.get('/fast/{rows}', response_model=FastUI, response_model_exclude_none=True)
+    def fast_table(rows: int) -> Response:
+        return demo_page_response(table_json(City, cities[:rows], columns=COLUMNS), title='Cities')
+
+    return app
+
+
+def run(requests: int) -> list[dict]:
+    client = TestClient(build_app(synthetic_cities(max(SIZES))))
+    results = []
+    for rows in SIZES:
+        for path in ('default', 'fast'):
+            url = f'/{path}/{rows}'
+            body = client.get(url).content
+            timings = []
+            for _ in range(requests):
+                start = time.perf_counter()
+                client.get(url)
+                timings.append((time.perf_counter() - start) * 1000)
+            results.append({
+                'path': path,
+                'rows': rows,
+                'requests': requests,
+                'p50_ms': round(statistics.median(timings), 3),
+                'p99_ms': round(percentile(timings, 99), 3),
+                'bytes': len(body),
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    results = run(args.requests)
+    for r in results:
+        print(f"{r['path']:>8} {r['rows']:>5} rows  p50 {r['p50_ms']:8.3f} ms  p99 {r['p99_ms']:8.3f} ms  {r['bytes']:>8} bytes")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()